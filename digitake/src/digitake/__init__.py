@@ -1,4 +1,14 @@
-from . import gpu_utils, labnote, preprocess, view, model
+import importlib
+
+# submodules are imported on first access, e.g. `labnote` pulls in gspread and `view` pulls in matplotlib
+__all__ = ['gpu_utils', 'labnote', 'preprocess', 'view', 'model']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def about():
     print("Digitake!")
@@ -8,7 +8,16 @@ from typing import Dict
 imagenet_mean = [0.485, 0.456, 0.406]
 imagenet_std = [0.229, 0.224, 0.225]
 
+# the 4th channel of `with_alpha_channel`, a binary mask i.e. 0 or 1 -> -1 or 1
+mask_mean = [0.5]
+mask_std = [0.5]
+
 from .thyroid import ThyroidDataset
+from .cache import SharedImageCache
+from .shard import ShardDataset, build_shard
+from .batch_transform import BatchTransform, BatchTransformLoader, get_uint8_transform
+from .manifest import DatasetManifest
+from .mask_store import MaskStore, build_mask_store
 
 
 ####################################################################
@@ -68,7 +77,45 @@ def get_transform(target_size, phase='train'):
         raise Exception("Unknown phase specified")
 
 
-def build_dataset(datasource: Dict[str, str], root="", ext="*.png"):
+def get_batch_transform(target_size, phase='train', with_alpha_channel=False):
+    """
+    Batched counterpart of `get_transform`, the workers only resize and the rest runs on the collated batch
+    :param target_size: tuple of (W,H) result image from the pipe
+    :param phase: basic/train/val/test phase of different transformation e.g. test will not need RandomCrop,
+                  basic only resizes to `target_size`
+    :param with_alpha_channel: if True, normalize RGBA images, the alpha channel being a mask
+    :return: tuple of (worker transform emitting uint8 tensors, BatchTransform for the collated batch)
+    """
+    if type(target_size) is int:
+        target_size = (target_size, target_size)
+
+    assert type(target_size) is tuple, "target_size must be tuple of (W:int, H:int) or int if square is needed"
+
+    # enlarge 10% bigger for the later cropping
+    enlarge = (int(target_size[0] * 1.1), int(target_size[1] * 1.1))
+
+    if with_alpha_channel:
+        norm = {'mean': imagenet_mean + mask_mean, 'std': imagenet_std + mask_std}
+    else:
+        norm = {'mean': imagenet_mean, 'std': imagenet_std}
+
+    # (worker output size, batch transform)
+    transform_dict = {
+        'basic': (target_size, BatchTransform(target_size, **norm)),
+        'train': (enlarge, BatchTransform(target_size, rotation=45, hflip=0.5, perspective=0.2,
+                                          brightness=0.126, contrast=0.2, jitter_p=0.5, **norm)),
+        'val': (enlarge, BatchTransform(target_size, **norm)),
+        'test': (enlarge, BatchTransform(target_size, **norm))
+    }
+
+    if phase in transform_dict:
+        size, batch_transform = transform_dict[phase]
+        return get_uint8_transform(size), batch_transform
+    else:
+        raise Exception("Unknown phase specified")
+
+
+def build_dataset(datasource: Dict[str, str], root="", ext="*.png", manifest=None):
     """
     Build dataset by consuming data from root/<datasource-key>
 
@@ -84,17 +131,26 @@ def build_dataset(datasource: Dict[str, str], root="", ext="*.png"):
     }
     :param root: the root path to be prepended to datasource-key, default is emptu
     :param ext: the file extension to search for
+    :param manifest: (optional) DatasetManifest or its path, so that only the directories changed since the last
+                     build are scanned again
     :return: a dictionary of data split by corresponding label name e.g. { 'benign', 'malignant'}
     """
+    if isinstance(manifest, str):
+        manifest = DatasetManifest(manifest)
+    find = manifest.glob if manifest is not None else glob.glob
+
     datasets = {}
     for key in datasource:
         if isinstance(datasource[key], list):
             files = []
             for path in datasource[key]:
-                files += glob.glob(os.path.join(root, path, ext))
+                files += find(os.path.join(root, path, ext))
             datasets[key] = files
         else:
-            datasets[key] = glob.glob(os.path.join(root, datasource[key], ext))
+            datasets[key] = find(os.path.join(root, datasource[key], ext))
+
+    if manifest is not None:
+        manifest.save()
 
     return datasets
 
@@ -110,7 +166,7 @@ def explain_dataset(ds):
     return s
 
 
-def build_train_validation_set(datasource, val_size, root="", ext="*.png"):
+def build_train_validation_set(datasource, val_size, root="", ext="*.png", manifest=None):
     """
     This function loop over each datasource's key and append it to <root> to make a search path to scan for
     files with given extension. The list of file then, will be splitted into training and validation set.
@@ -122,10 +178,11 @@ def build_train_validation_set(datasource, val_size, root="", ext="*.png"):
     :param val_size: validation size, must be greater than total datasource size of each class's dataset
     :param root: the root path to be prepended to datasource, default is empty
     :param ext: the file extension to search for
+    :param manifest: (optional) DatasetManifest or its path, see `build_dataset`
     :return a dictionary of data split by corresponding class name e.g. { 'benign', 'malignant'}
     """
     # Build dataset according to datasource dict[class: path]. e.g. { 'benign': 'benign/folder' }
-    datasets = build_dataset(datasource, root=root, ext=ext)
+    datasets = build_dataset(datasource, root=root, ext=ext, manifest=manifest)
 
     training_set = {}
     validation_set = {}
@@ -0,0 +1,183 @@
+import math
+
+import torch
+import torchvision.transforms as transforms
+from torch import nn
+from torch.nn import functional
+
+# imagenet mean and std
+imagenet_mean = [0.485, 0.456, 0.406]
+imagenet_std = [0.229, 0.224, 0.225]
+
+
+def get_uint8_transform(size):
+    """
+    Worker side of a batched transform: only resize, and emit uint8 tensors so that the batch travels 4x smaller
+    :param size: tuple of (H, W) of the emitted images
+    """
+    return transforms.Compose([
+        transforms.Resize(size),
+        transforms.PILToTensor()
+    ])
+
+
+def _perspective_coeffs(src, dst):
+    """
+    Batched homography coefficients mapping each of the 4 `src` points to its `dst` point
+    :param src: (B, 4, 2) points
+    :param dst: (B, 4, 2) points
+    :return: (B, 8) coefficients (a, b, c, d, e, f, g, h) of u = (ax+by+c)/(gx+hy+1), v = (dx+ey+f)/(gx+hy+1)
+    """
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    one, zero = torch.ones_like(x), torch.zeros_like(x)
+    rows_u = torch.stack([x, y, one, zero, zero, zero, -u * x, -u * y], dim=-1)
+    rows_v = torch.stack([zero, zero, zero, x, y, one, -v * x, -v * y], dim=-1)
+    a = torch.cat([rows_u, rows_v], dim=1)  # (B, 8, 8)
+    b = torch.cat([u, v], dim=1)  # (B, 8)
+    return torch.linalg.solve(a, b)
+
+
+class BatchTransform(nn.Module):
+    """
+    Tensor-side augmentation applied to a whole collated uint8 batch on the compute device
+
+    It follows the PIL pipeline of `get_transform` i.e. RandomRotation(expand=True) -> CenterCrop -> RandomHorizontalFlip
+    -> RandomPerspective -> RandomApply(ColorJitter) -> ToTensor -> Normalize, but every random parameter is drawn
+    per sample as a tensor and the geometric part is resampled with a single `grid_sample` call.
+    """
+
+    def __init__(self, target_size, rotation=0., hflip=0., perspective=0., perspective_p=0.5,
+                 brightness=0., contrast=0., jitter_p=0., mean=imagenet_mean, std=imagenet_std, generator=None):
+        """
+        :param target_size: tuple of (H, W) of the output images
+        :param rotation: rotation range in degrees, the angle is drawn from (-rotation, rotation)
+        :param hflip: probability of the horizontal flip
+        :param perspective: distortion scale of the random perspective
+        :param perspective_p: probability of the random perspective
+        :param brightness: brightness jitter, the factor is drawn from (1 - brightness, 1 + brightness)
+        :param contrast: contrast jitter, the factor is drawn from (1 - contrast, 1 + contrast)
+        :param jitter_p: probability of the color jitter
+        :param mean: normalization mean per channel
+        :param std: normalization std per channel
+        :param generator: (optional) torch.Generator on the compute device, for reproducible augmentation
+        """
+        super(BatchTransform, self).__init__()
+        if type(target_size) is int:
+            target_size = (target_size, target_size)
+
+        self.target_size = target_size
+        self.rotation = rotation
+        self.hflip = hflip
+        self.perspective = perspective
+        self.perspective_p = perspective_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.jitter_p = jitter_p
+        self.generator = generator
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def _rand(self, n, device):
+        return torch.rand(n, device=device, generator=self.generator)
+
+    def _uniform(self, n, low, high, device):
+        return low + (high - low) * self._rand(n, device)
+
+    def _grid(self, batches, in_h, in_w, device):
+        out_h, out_w = self.target_size
+
+        # output pixel centers, relative to the image center
+        ys = torch.arange(out_h, device=device, dtype=torch.float32) + 0.5
+        xs = torch.arange(out_w, device=device, dtype=torch.float32) + 0.5
+        y, x = torch.meshgrid(ys, xs, indexing='ij')
+        x = x.expand(batches, out_h, out_w)
+        y = y.expand(batches, out_h, out_w)
+
+        if self.perspective > 0:
+            # inverse of the distortion moving each corner inward by up to `perspective` of the half size
+            corners = torch.tensor([[0., 0.], [out_w, 0.], [out_w, out_h], [0., out_h]], device=device)
+            inward = torch.tensor([[1., 1.], [-1., 1.], [-1., -1.], [1., -1.]], device=device)
+            half = torch.tensor([out_w / 2., out_h / 2.], device=device)
+            offsets = self._rand(batches * 8, device).view(batches, 4, 2) * self.perspective * half
+            offsets = offsets * (self._rand(batches, device) < self.perspective_p).view(-1, 1, 1)
+            src = corners.expand(batches, 4, 2)
+            coeffs = _perspective_coeffs(src + inward * offsets, src)  # output -> input
+            a, b, c, d, e, f, g, h = [coeffs[:, i].view(-1, 1, 1) for i in range(8)]
+            denominator = g * x + h * y + 1.
+            x, y = (a * x + b * y + c) / denominator, (d * x + e * y + f) / denominator
+
+        x = x - out_w / 2.
+        y = y - out_h / 2.
+
+        if self.hflip > 0:
+            flip = (self._rand(batches, device) < self.hflip).view(-1, 1, 1)
+            x = torch.where(flip, -x, x)
+
+        if self.rotation > 0:
+            # rotating around the center with `expand=True` then center cropping, keeps the center-relative coordinates
+            angle = self._uniform(batches, -self.rotation, self.rotation, device) * math.pi / 180.
+            cos, sin = torch.cos(angle).view(-1, 1, 1), torch.sin(angle).view(-1, 1, 1)
+            x, y = cos * x - sin * y, sin * x + cos * y
+
+        # to the normalized coordinates of the input, i.e. `align_corners=False`
+        return torch.stack([x * 2. / in_w, y * 2. / in_h], dim=-1)
+
+    def forward(self, images):
+        """
+        :param images: uint8 tensor of shape (B, C, H, W), e.g. a batch emitted by `get_uint8_transform`
+        :return: normalized float tensor of shape (B, C, *target_size)
+        """
+        batches, _, in_h, in_w = images.size()
+        out_h, out_w = self.target_size
+        device = images.device
+        images = images.float().div_(255.)
+
+        if self.rotation > 0 or self.hflip > 0 or self.perspective > 0:
+            grid = self._grid(batches, in_h, in_w, device)
+            images = functional.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        elif (in_h, in_w) != (out_h, out_w):
+            top = int(round((in_h - out_h) / 2.))
+            left = int(round((in_w - out_w) / 2.))
+            images = images[:, :, top:top + out_h, left:left + out_w]
+
+        if self.jitter_p > 0 and (self.brightness > 0 or self.contrast > 0):
+            apply = (self._rand(batches, device) < self.jitter_p).view(-1, 1, 1, 1)
+            jittered = images[:, :3]  # the color channels only, e.g. not the mask of an RGBA image
+            if self.brightness > 0:
+                factor = self._uniform(batches, 1. - self.brightness, 1. + self.brightness, device).view(-1, 1, 1, 1)
+                jittered = (jittered * factor).clamp_(0., 1.)
+            if self.contrast > 0:
+                factor = self._uniform(batches, 1. - self.contrast, 1. + self.contrast, device).view(-1, 1, 1, 1)
+                gray = (0.299 * jittered[:, 0] + 0.587 * jittered[:, 1] + 0.114 * jittered[:, 2])
+                gray_mean = gray.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+                jittered = (factor * jittered + (1. - factor) * gray_mean).clamp_(0., 1.)
+            if images.size(1) > 3:
+                jittered = torch.cat([jittered, images[:, 3:]], dim=1)
+            images = torch.where(apply, jittered, images)
+
+        return (images - self.mean) / self.std
+
+
+class BatchTransformLoader:
+    """
+    Wrap a DataLoader emitting uint8 batches, so that each batch is moved to `device` and transformed there
+    """
+
+    def __init__(self, data_loader, batch_transform, device):
+        self.data_loader = data_loader
+        self.batch_transform = batch_transform.to(device)
+        self.device = device
+
+    @property
+    def dataset(self):
+        return self.data_loader.dataset
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for X, *rest in self.data_loader:
+            with torch.no_grad():  # not around the `yield`, the grad mode would leak into the consumer
+                X = self.batch_transform(X.to(self.device, non_blocking=True))
+            yield (X, *rest)
@@ -0,0 +1,108 @@
+import multiprocessing
+
+import numpy as np
+import torch
+
+# indices into `SharedImageCache.counters`
+_CLOCK, _HITS, _MISSES = 0, 1, 2
+
+
+class SharedImageCache:
+    """
+    Byte-budgeted LRU cache of decoded uint8 images shared by every DataLoader worker
+
+    All cached images have the same (H, W, C) shape (they are resized to the target size before being stored),
+    so the arena is one shared-memory tensor split into equally sized slots. The slot tables, the LRU clock and
+    the hit/miss counters live in shared memory as well, so an image decoded by one worker is a hit for all others.
+    """
+
+    def __init__(self, num_items, size, budget_bytes, channels=3):
+        """
+        :param num_items: number of items that can be cached, items are keyed by their linear index [0, num_items)
+        :param size: tuple of (H, W) of the cached images, or int if square
+        :param budget_bytes: upper bound of the bytes used by the image arena
+        :param channels: number of channels of the cached images e.g. 3 for RGB, 4 for RGBA
+        """
+        if type(size) is int:
+            size = (size, size)
+
+        assert type(size) is tuple, "size must be tuple of (H:int, W:int) or int if square is needed"
+
+        self.size = size
+        self.item_shape = (size[0], size[1], channels)
+        self.item_bytes = int(np.prod(self.item_shape))
+        self.num_items = num_items
+        self.num_slots = min(num_items, budget_bytes // self.item_bytes)
+
+        assert self.num_slots > 0, f"budget_bytes({budget_bytes}) is smaller than a single image({self.item_bytes})"
+
+        self.arena = torch.zeros((self.num_slots,) + self.item_shape, dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((num_items,), -1, dtype=torch.int64).share_memory_()  # item -> slot
+        self.owner = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()  # slot -> item
+        self.last_used = torch.zeros(self.num_slots, dtype=torch.int64).share_memory_()  # 0 means never used
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def _touch(self, slot):
+        self.counters[_CLOCK] += 1
+        self.last_used[slot] = self.counters[_CLOCK]
+
+    def get(self, index, load):
+        """
+        Return the cached image of item `index`, calling `load()` to produce it on a miss
+        :param index: linear index of the item
+        :param load: a function returning the image as uint8 array of shape (H, W, C)
+        :return: uint8 array of shape (H, W, C), owned by the caller
+        """
+        with self.lock:
+            slot = int(self.slot_of[index])
+            if slot >= 0:
+                self._touch(slot)
+                self.counters[_HITS] += 1
+                return self.arena[slot].numpy().copy()  # copy under the lock, the slot may be evicted later
+
+        # decode outside of the lock so that workers don't serialize on it
+        image = np.ascontiguousarray(load(), dtype=np.uint8)
+        assert image.shape == self.item_shape, f"Expected image of shape {self.item_shape}, got {image.shape}"
+
+        with self.lock:
+            self.counters[_MISSES] += 1
+            slot = int(self.slot_of[index])
+            if slot < 0:  # not stored by another worker in the meantime
+                slot = int(torch.argmin(self.last_used))  # a free slot or the least recently used one
+                evicted = int(self.owner[slot])
+                if evicted >= 0:
+                    self.slot_of[evicted] = -1
+                self.arena[slot].numpy()[...] = image
+                self.owner[slot] = index
+                self.slot_of[index] = slot
+            self._touch(slot)
+
+        return image
+
+    def clear(self):
+        with self.lock:
+            self.slot_of.fill_(-1)
+            self.owner.fill_(-1)
+            self.last_used.zero_()
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters[_HITS] = 0
+            self.counters[_MISSES] = 0
+
+    def stats(self):
+        hits, misses = int(self.counters[_HITS]), int(self.counters[_MISSES])
+        used = int((self.owner >= 0).sum())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.,
+            'used_bytes': used * self.item_bytes,
+            'budget_bytes': self.num_slots * self.item_bytes,
+        }
+
+    def __str__(self):
+        s = self.stats()
+        return (f"Cache hits {s['hits']}, misses {s['misses']} ({s['hit_rate'] * 100:.1f}%), "
+                f"{s['used_bytes'] / 2 ** 20:.1f}/{s['budget_bytes'] / 2 ** 20:.1f} MiB")
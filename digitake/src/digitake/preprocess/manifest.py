@@ -0,0 +1,118 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    :return: hex digest of the content of the file at `path`
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetManifest:
+    """
+    On-disk record of the files found by `build_dataset`: their size, mtime and content hash
+
+    A search path is globbed again only when the mtime of its directory changed(i.e. files were added, removed or
+    renamed), so a cached search path costs a single stat. As overwriting a file in place leaves the directory mtime
+    as is, `get_hash` stats the file and hashes it again when its size or mtime changed. The content hashes are stable
+    keys for the downstream caches e.g. decoded images, doppler bboxes or predictions.
+    """
+
+    def __init__(self, path, workers=8, verify=False):
+        """
+        :param path: the manifest file, loaded if it exists
+        :param workers: number of threads hashing the files, hashing is I/O bound on network filesystems
+        :param verify: if True, `glob` also stats the files of a cached search path, rehashing the changed ones
+        """
+        self.path = path
+        self.workers = workers
+        self.verify = verify
+        self.patterns = {}  # search path -> {'mtime_ns': int, 'files': [path]}
+        self.files = {}  # path -> [size, mtime_ns, digest]
+        self.dirty = False
+
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.patterns = manifest['patterns']
+                self.files = manifest['files']
+
+    def glob(self, pattern):
+        """
+        Same as `glob.glob(pattern)` for a pattern of files within a single directory, e.g. 'path/a/benign/*.png'
+        """
+        directory = os.path.dirname(pattern)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        entry = self.patterns.get(pattern)
+        if entry is not None and entry['mtime_ns'] == mtime_ns:
+            if self.verify and self.__update_files(entry['files']):  # overwritten in place
+                self.dirty = True
+            return list(entry['files'])
+
+        files = glob.glob(pattern)
+        if entry is not None:
+            for path in set(entry['files']) - set(files):  # removed since the last scan
+                self.files.pop(path, None)
+        self.patterns[pattern] = {'mtime_ns': mtime_ns, 'files': files}
+        self.__update_files(files)
+        self.dirty = True
+        return list(files)
+
+    def __update_files(self, files):
+        """
+        :return: True if any of `files` was (re)hashed
+        """
+        stale = []
+        for path in files:
+            st = os.stat(path)
+            record = self.files.get(path)
+            if record is None or record[0] != st.st_size or record[1] != st.st_mtime_ns:
+                stale.append((path, st.st_size, st.st_mtime_ns))
+
+        if not stale:
+            return False
+
+        with ThreadPoolExecutor(min(self.workers, len(stale))) as executor:
+            digests = executor.map(hash_file, [path for (path, _, _) in stale])
+            for (path, size, mtime_ns), digest in zip(stale, digests):
+                self.files[path] = [size, mtime_ns, digest]
+        return True
+
+    def get_hash(self, path):
+        """
+        :return: content hash of the file at `path`, hashing it if it isn't recorded yet or changed since
+        """
+        if self.__update_files([path]):
+            self.dirty = True
+        return self.files[path][2]
+
+    def save(self):
+        if not self.dirty:
+            return
+        # unique in the same directory, so that concurrent writers don't share it and the replace stays atomic
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                        dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'patterns': self.patterns, 'files': self.files}, f)
+            os.replace(tmp_path, self.path)  # atomic, a concurrent reader sees either the old or the new manifest
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.dirty = False
@@ -0,0 +1,110 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+MASK_STORE_VERSION = 1
+
+
+def _pack_mask(args):
+    mask_fn, path, size = args
+    mask = mask_fn(path)
+    if mask is None:
+        return None
+    h, w = size
+    mask = Image.fromarray((np.asarray(mask) > 0).astype(np.uint8) * 255)
+    return np.packbits(np.asarray(mask.resize((w, h), Image.NEAREST)) > 0, axis=-1)
+
+
+def build_mask_store(mask_fn, paths, prefix, size, workers=0):
+    """
+    Precompute binary masks once, bit-packed at the training resolution
+
+    Writes `<prefix>.npy`, an array of shape (N, H, ceil(W / 8)) that can be memory-mapped, and `<prefix>.json`, the
+    index of the paths having a mask. A (256, 256) mask takes 8KB.
+
+    :param mask_fn: picklable function mapping a path to a 2D bool or uint8 array(nonzero is set) of any size, or None
+                    if the path has no mask
+    :param paths: the image paths the masks are keyed by
+    :param prefix: the output path without extension
+    :param size: tuple of (H, W) of the stored masks, or int if square
+    :param workers: number of processes running `mask_fn`, 0 means running it in the calling process
+    :return: the index dictionary
+    """
+    if type(size) is int:
+        size = (size, size)
+
+    jobs = [(mask_fn, path, size) for path in paths]
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as executor:
+            packed = list(executor.map(_pack_mask, jobs, chunksize=16))
+    else:
+        packed = [_pack_mask(job) for job in jobs]
+
+    kept = [(path, bits) for path, bits in zip(paths, packed) if bits is not None]
+    masks = np.lib.format.open_memmap(f'{prefix}.npy', mode='w+', dtype=np.uint8,
+                                      shape=(len(kept), size[0], (size[1] + 7) // 8))
+    for i, (_, bits) in enumerate(kept):
+        masks[i] = bits
+    masks.flush()
+    del masks
+
+    index = {
+        'version': MASK_STORE_VERSION,
+        'size': list(size),
+        'paths': [path for path, _ in kept],
+    }
+    with open(f'{prefix}.json', 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class MaskStore:
+    """
+    Read-only view of the masks packed by `build_mask_store`, through numpy.memmap
+
+    `get` unpacks a mask without decoding any image, e.g. for the alpha channel of ThyroidDataset.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: the mask store path without extension
+        """
+        self.prefix = prefix
+
+        with open(f'{prefix}.json') as f:
+            index = json.load(f)
+        assert index['version'] == MASK_STORE_VERSION, f"Unsupported mask store version {index['version']}"
+
+        self.size = tuple(index['size'])
+        self.index = {path: i for i, path in enumerate(index['paths'])}
+        self._masks = None
+
+    @property
+    def masks(self):
+        # mapped lazily, so each DataLoader worker maps the file itself instead of receiving a pickled copy
+        if self._masks is None:
+            self._masks = np.load(f'{self.prefix}.npy', mmap_mode='r')
+        return self._masks
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_masks'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def get(self, path):
+        """
+        :return: uint8 array of shape (H, W) with values 0 or 255, or None if `path` has no mask
+        """
+        i = self.index.get(path)
+        if i is None:
+            return None
+        return np.unpackbits(self.masks[i], axis=-1, count=self.size[1]) * np.uint8(255)
@@ -0,0 +1,158 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+SHARD_VERSION = 1
+
+
+def _load_resized(args):
+    path, size, mask = args
+    h, w = size
+    image = np.asarray(Image.open(path).convert('RGB').resize((w, h), Image.BILINEAR))
+    if mask is False:
+        return image
+    # the alpha is resized on its own, as PIL premultiplies the colors by it when resizing RGBA
+    alpha = np.zeros((h, w), dtype=np.uint8) if mask is None else \
+        np.asarray(Image.fromarray(mask).resize((w, h), Image.NEAREST))
+    return np.dstack([image, alpha])
+
+
+def build_shard(dataset, prefix, size, meta_fn=None, mask_store=None, workers=0):
+    """
+    Pack a dataset into one pre-resized uint8 array file plus its index
+
+    Writes `<prefix>.npy`, an array of shape (N, H, W, C) that can be memory-mapped, and `<prefix>.json`, the index of
+    labels, class indices, paths and per-sample metadata. Samples are ordered like ThyroidDataset, i.e. by sorted label.
+
+    :param dataset: a dictionary of label to list of paths, as returned by `build_dataset`
+    :param prefix: the output path without extension
+    :param size: tuple of (H, W) of the packed images, or int if square
+    :param meta_fn: (optional) function mapping a path to a json-serializable dict of metadata e.g. doppler path
+    :param mask_store: (optional) MaskStore whose masks are packed as the alpha channel(RGBA), the same as
+                       ThyroidDataset serves them; a path without a stored mask gets an empty(zero) alpha channel
+    :param workers: number of decoding processes, 0 means decoding in the calling process
+    :return: the index dictionary
+    """
+    if type(size) is int:
+        size = (size, size)
+
+    labels = sorted(dataset.keys())
+    paths = [path for label in labels for path in dataset[label]]
+    class_index = [k for k, label in enumerate(labels) for _ in dataset[label]]
+    mode = 'RGBA' if mask_store is not None else 'RGB'
+
+    images = np.lib.format.open_memmap(f'{prefix}.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), size[0], size[1], len(mode)))
+    # the masks are read here, the store being memory-mapped, rather than pickled along with the store for each job
+    jobs = [(path, size, mask_store.get(path) if mask_store is not None else False) for path in paths]
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as executor:
+            for i, image in enumerate(executor.map(_load_resized, jobs, chunksize=16)):
+                images[i] = image
+    else:
+        for i, job in enumerate(jobs):
+            images[i] = _load_resized(job)
+    images.flush()
+    del images
+
+    index = {
+        'version': SHARD_VERSION,
+        'size': list(size),
+        'mode': mode,
+        'labels': labels,
+        'class_index': class_index,
+        'paths': paths,
+        'meta': [meta_fn(path) for path in paths] if meta_fn is not None else None,
+    }
+    with open(f'{prefix}.json', 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class ShardDataset(Dataset):
+    """
+    Dataset reading the samples of a shard packed by `build_shard` through numpy.memmap
+
+    The returned tuple is the same as ThyroidDataset's i.e. (image, class_index, extra).
+    """
+
+    def __init__(self, phase, prefix, transform=None, compact_extra=False):
+        """
+        :param phase: Train/Validation/Test phase
+        :param prefix: the shard path without extension
+        :param transform: (optional) the transform function taking a PIL image,
+                          if None, the image is returned as uint8 tensor of shape (C, H, W)
+        :param compact_extra: (optional) if True, extra is the integer sample id instead of a dict
+        """
+        assert phase is not None
+        self.phase = phase
+        self.prefix = prefix
+        self.transform = transform
+        self.compact_extra = compact_extra
+
+        with open(f'{prefix}.json') as f:
+            index = json.load(f)
+        assert index['version'] == SHARD_VERSION, f"Unsupported shard version {index['version']}"
+
+        self.labels = index['labels']
+        self.paths = index['paths']
+        self.meta = index['meta']
+        self.class_indices = np.asarray(index['class_index'], dtype=np.int64)
+        self.partition = [(label, int((self.class_indices == k).sum())) for k, label in enumerate(self.labels)]
+        self.offsets = np.cumsum([0] + [v for (_, v) in self.partition[:-1]], dtype=np.int64)
+        self._images = None
+
+    @property
+    def images(self):
+        # mapped lazily, so each DataLoader worker maps the file itself instead of receiving a pickled copy
+        if self._images is None:
+            self._images = np.load(f'{self.prefix}.npy', mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        class_index = int(self.class_indices[index])
+        image = self.images[index]  # a view of the page cache, no decoding
+
+        if self.transform is not None:
+            image = self.transform(Image.fromarray(image))
+        else:
+            image = torch.tensor(image).permute(2, 0, 1)
+
+        extra = index if self.compact_extra else self.get_extra(index)
+        return image, class_index, extra
+
+    def get_extra(self, sample_id):
+        sample_id = int(sample_id)
+        class_index = int(self.class_indices[sample_id])
+        return {
+            'path': self.paths[sample_id],
+            'label': self.labels[class_index],
+            'class_index': class_index,
+            'inclass_index': sample_id - int(self.offsets[class_index])
+        }
+
+    def get_path(self, sample_id):
+        return self.paths[int(sample_id)]
+
+    def get_paths(self, sample_ids):
+        return [self.paths[i] for i in np.asarray(sample_ids).reshape(-1).tolist()]
+
+    def get_meta(self, sample_id):
+        return self.meta[int(sample_id)] if self.meta is not None else None
+
+    def get_class_label(self, class_index):
+        assert class_index < len(self.partition), 'The class_index is beyond number of class available'
+        return self.partition[class_index][0]
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.data.dataset import T_co
@@ -8,46 +11,84 @@ class ThyroidDataset(Dataset):
     Dataset for Thyroid Image
     """
 
-    def __init__(self, phase, dataset, transform, mask_dict=None, with_alpha_channel=True):
+    def __init__(self, phase, dataset, transform, mask_dict=None, with_alpha_channel=True, cache=None,
+                 compact_extra=False, mask_store=None):
         """
 
         :param phase: Train/Validation/Test phase
         :param dataset: the dataset to be loaded(in form on path)
         :param transform: the transform function
-        :param mask_dict: (optional) dictionary that map from a given path in the dataset to mask path
+        :param mask_dict: (optional) dictionary that map from a label to the list of mask paths(matched by filename),
+                          or from a given path in the dataset to mask path
         :param with_alpha_channel: (optional) if False, it will load image as RGB(3-channel)
+        :param cache: (optional) SharedImageCache keeping the decoded images, resized to the cache size
+        :param compact_extra: (optional) if True, extra is the integer sample id instead of a dict,
+                              use get_path/get_paths/get_extra to look it up
+        :param mask_store: (optional) MaskStore serving the alpha channel instead of `mask_dict`, so that no mask
+                           image is decoded; a path without a stored mask gets an empty(zero) alpha channel
         """
         assert phase is not None
         assert dataset is not None
         assert transform is not None
         self.phase = phase
         self.dataset = dataset
-        self.partition = [(k, len(v)) for k, v in sorted(self.dataset.items())]
+        self.__build_index()
         self.transform = transform
         self.mask_dict = mask_dict if mask_dict is not None and type(mask_dict) == dict else {}
+        self.__build_mask_index()
         self.extra_channel_default = None
         self.with_alpha_channel = with_alpha_channel
+        self.cache = cache
+        self.compact_extra = compact_extra
+        self.mask_store = mask_store
 
     def set_dataset(self, dataset):
         self.dataset = dataset
+        self.__build_index()
+        if self.cache is not None:
+            self.cache.clear()  # cache is keyed by linear index
+
+    def __build_index(self):
         self.partition = [(k, len(v)) for k, v in sorted(self.dataset.items())]  # Create a partition indices
 
+        # flat lookup tables of linear index, so that neither __len__ nor __getitem__ walk the partitions
+        sizes = [v for (_, v) in self.partition]
+        self.paths = [path for (k, _) in self.partition for path in self.dataset[k]]
+        self.class_indices = np.repeat(np.arange(len(sizes), dtype=np.int64), sizes)
+        self.offsets = np.cumsum([0] + sizes[:-1], dtype=np.int64)
+
+    def __build_mask_index(self):
+        # hash the masks once, so that finding the counterpart of an image doesn't scan the whole mask list
+        self.mask_index = {}
+        for key, value in self.mask_dict.items():
+            if isinstance(value, (list, tuple)):
+                # label -> {filename -> mask path}
+                self.mask_index[key] = {os.path.basename(p): p for p in value}
+            else:
+                # path -> mask path
+                self.mask_index[key] = value
+
+    def get_mask_path(self, path, label):
+        mask_path = self.mask_index.get(path)
+        if isinstance(mask_path, str):
+            return mask_path
+
+        masks = self.mask_index.get(label)
+        if isinstance(masks, dict):
+            return masks.get(os.path.basename(path))  # extract the filename of image to find its counterpart
+        return None
+
     def __len__(self):
-        size = len(sum(self.dataset.values(), []))  # monoid flatten, it's counting item so order doesn't matter
-        return size
+        return len(self.paths)
 
     def __get_partitioned_index(self, index):
         if index < 0:
             raise IndexError(f"Index must not be negative")
+        if index >= len(self.paths):
+            raise IndexError(f"Index is out of range {index}")
 
-        class_num = 0
-        for (k, v) in self.partition:
-            if index >= v:
-                index -= v
-                class_num += 1
-            else:
-                return k, class_num, index
-        raise IndexError(f"Index is out of range {index}")
+        class_num = int(self.class_indices[index])
+        return self.partition[class_num][0], class_num, index - int(self.offsets[class_num])
 
     def __getitem__(self, index) -> T_co:
         """
@@ -57,48 +98,83 @@ class ThyroidDataset(Dataset):
         """
         # convert linear index into index respecting its partition
         # e.g. [0,1,2,3,4,5,6,7,8] --> [0,1,2,3,0,1,2,3,4]
-        label, class_index, index = self.__get_partitioned_index(index)
-        path = self.dataset[label][index]
+        label, class_index, inclass_index = self.__get_partitioned_index(index)
+        path = self.paths[index]
 
-        extra = {
-            'path': path,
-            'label': label,
-            'class_index': class_index,
-            'inclass_index': index
-        }
+        if self.compact_extra:
+            extra = index  # collated into a single int64 tensor rather than lists of strings
+        else:
+            extra = {
+                'path': path,
+                'label': label,
+                'class_index': class_index,
+                'inclass_index': inclass_index
+            }
+
+        # load, or reuse the image decoded(and resized) before by any of the workers
+        if self.cache is not None:
+            image = Image.fromarray(self.cache.get(index, lambda: self.__load_resized(path, label)))
+        else:
+            image = self.load_image(path, label)
 
-        # load and transform
-        image = Image.open(path).convert('RGB')
+        transformed_image = self.transform(image)
 
-        try:
-            extracted_filename = path.split('/')[-1]  # extract the filename of image to find its counterpart
-            mask_path = next(p for p in self.mask_dict[label] if extracted_filename in p)
-        except StopIteration:
-            mask_path = None
-        except KeyError:
-            mask_path = None
+        # return image and label
+        return transformed_image, class_index, extra
 
-        if self.with_alpha_channel:
+    def load_image(self, path, label):
+        """
+        Decode the image at `path`, merging the mask of `label` as an alpha channel when enabled
+        :return: PIL image in RGB or RGBA mode
+        """
+        decoded = Image.open(path)
+        image = decoded.convert('RGB')
+
+        if self.with_alpha_channel and self.mask_store is not None:
+            mask = self.mask_store.get(path)
+            if mask is None:
+                mask_image = Image.new('L', image.size, 0)
+            else:
+                mask_image = Image.fromarray(mask).resize(image.size, Image.NEAREST)
+            r, g, b = image.split()
+            image = Image.merge('RGBA', (r, g, b, mask_image))
+        elif self.with_alpha_channel:
+            mask_path = self.get_mask_path(path, label)
             # if it has mask, find the mask path pair and load
             if mask_path:
                 # Gray scale image(this could actually be just B/W Image(0/1)
                 mask_image = Image.open(mask_path).convert('L')
-                r, g, b = image.split()
-                image = Image.merge('RGBA', (r, g, b, mask_image))
             else:
-                gray_image = Image.open(path).convert('L')
+                mask_image = decoded.convert('L')  # reuse the decoded pixels rather than reopening the file
                 if self.extra_channel_default and type(self.extra_channel_default) == int:
-                    gray_image.point(lambda _i: self.extra_channel_default)
-                r, g, b = image.split()
-                image = Image.merge('RGBA', (r, g, b, gray_image))
-        else:
-            # load and transform
-            image = Image.open(path).convert('RGB')
+                    mask_image.point(lambda _i: self.extra_channel_default)
+            r, g, b = image.split()
+            image = Image.merge('RGBA', (r, g, b, mask_image))
 
-        transformed_image = self.transform(image)
+        return image
 
-        # return image and label
-        return transformed_image, class_index, extra
+    def __load_resized(self, path, label):
+        h, w = self.cache.size
+        return np.asarray(self.load_image(path, label).resize((w, h), Image.BILINEAR))
+
+    def get_extra(self, sample_id):
+        label, class_index, inclass_index = self.__get_partitioned_index(int(sample_id))
+        return {
+            'path': self.paths[int(sample_id)],
+            'label': label,
+            'class_index': class_index,
+            'inclass_index': inclass_index
+        }
+
+    def get_path(self, sample_id):
+        return self.paths[int(sample_id)]
+
+    def get_paths(self, sample_ids):
+        """
+        :param sample_ids: a batch of sample ids, e.g. the collated extra when compact_extra is True
+        :return: list of paths
+        """
+        return [self.paths[i] for i in np.asarray(sample_ids).reshape(-1).tolist()]
 
     def get_class_label(self, class_index):
         assert class_index < len(self.partition), 'The class_index is beyond number of class available'
@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+import torchvision.transforms.functional as F
+from PIL import Image
+from torchvision.transforms import InterpolationMode
+
+from src.digitake.preprocess import get_batch_transform, get_transform, imagenet_mean, imagenet_std
+
+
+def _image():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 255, (40, 48, 3), dtype=np.uint8))
+
+
+def test_batch_transform_matches_val():
+    image = _image()
+    worker_transform, batch_transform = get_batch_transform(32, 'val')
+    batch = worker_transform(image)[None]
+    assert batch.dtype == torch.uint8
+
+    expected = get_transform(32, 'val')(image)
+    assert torch.allclose(batch_transform(batch)[0], expected, atol=1e-5)
+
+
+def test_batch_transform_train_shape():
+    worker_transform, batch_transform = get_batch_transform(32, 'train')
+    batch = torch.stack([worker_transform(_image())] * 4)
+    assert batch_transform(batch).shape == (4, 3, 32, 32)
+
+
+def test_batch_transform_train_geometry():
+    yy, xx = np.mgrid[0:50, 0:60]  # smooth, so that the interpolation differences stay small
+    image = np.stack([128 + 100 * np.sin(xx / 7.), 128 + 100 * np.cos(yy / 9.), 128 + 60 * np.sin((xx + yy) / 11.)], -1)
+    image = Image.fromarray(image.astype(np.uint8))
+
+    for perspective in (0., 0.2):
+        # sizes for which the CenterCrop of the rotated image is pixel aligned, as it rounds half pixels
+        worker_transform, batch_transform = get_batch_transform((40, 48), 'train')
+        batch_transform.jitter_p = 0.
+        batch_transform.perspective = perspective
+        batch_transform._rand = lambda n, device: torch.full((n,), 0.25, device=device)  # flip, -22.5 deg rotation
+        batch = worker_transform(image)[None]
+        output = batch_transform(batch)[0]
+
+        expected = F.rotate(batch[0].float() / 255., -22.5, InterpolationMode.BILINEAR, expand=True)
+        expected = F.hflip(F.center_crop(expected, [40, 48]))
+        if perspective > 0:  # each corner moved inward by 0.25 of the distortion
+            corners = [[0, 0], [48, 0], [48, 40], [0, 40]]
+            endpoints = [[x + dx * 0.25 * perspective * 24, y + dy * 0.25 * perspective * 20]
+                         for (x, y), (dx, dy) in zip(corners, [[1, 1], [-1, 1], [-1, -1], [1, -1]])]
+            expected = F.perspective(expected, corners, endpoints, InterpolationMode.BILINEAR)
+        expected = F.normalize(expected, imagenet_mean, imagenet_std)
+
+        if perspective > 0:  # but near the fill edges, interpolated twice by torchvision
+            assert torch.allclose(output[:, 6:-6, 6:-6], expected[:, 6:-6, 6:-6], atol=0.03)
+        else:
+            assert torch.allclose(output, expected, atol=1e-4)
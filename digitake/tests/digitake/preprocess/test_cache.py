@@ -0,0 +1,29 @@
+import numpy as np
+
+from src.digitake.preprocess.cache import SharedImageCache
+
+
+def _image(value):
+    return np.full((4, 4, 3), value, dtype=np.uint8)
+
+
+def test_shared_image_cache_hit_miss():
+    cache = SharedImageCache(3, 4, budget_bytes=2 * 4 * 4 * 3)
+    assert cache.num_slots == 2
+
+    assert (cache.get(0, lambda: _image(10)) == 10).all()
+    assert (cache.get(0, lambda: _image(99)) == 10).all()  # hit, not reloaded
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1), f"{stats}"
+
+
+def test_shared_image_cache_lru_eviction():
+    cache = SharedImageCache(3, 4, budget_bytes=2 * 4 * 4 * 3)
+    cache.get(0, lambda: _image(0))
+    cache.get(1, lambda: _image(1))
+    cache.get(0, lambda: _image(0))  # 1 is now the least recently used
+    cache.get(2, lambda: _image(2))  # evicts 1
+
+    assert (cache.get(1, lambda: _image(11)) == 11).all()
+    assert (cache.get(2, lambda: _image(22)) == 2).all()
+    assert cache.stats()['used_bytes'] == 2 * 4 * 4 * 3
@@ -0,0 +1,63 @@
+import os
+
+from src.digitake.preprocess import build_dataset
+from src.digitake.preprocess.manifest import DatasetManifest, hash_file
+
+
+def test_manifest_rescans_changed_directories(tmp_path):
+    (tmp_path / 'benign').mkdir()
+    (tmp_path / 'benign' / 'a.png').write_bytes(b'a')
+    manifest_path = str(tmp_path / 'manifest.json')
+
+    ds = build_dataset({'benign': 'benign'}, root=str(tmp_path), manifest=manifest_path)
+    assert [os.path.basename(p) for p in ds['benign']] == ['a.png']
+
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.get_hash(ds['benign'][0]) == hash_file(ds['benign'][0])
+
+    (tmp_path / 'benign' / 'b.png').write_bytes(b'b')
+    ds = build_dataset({'benign': 'benign'}, root=str(tmp_path), manifest=manifest)
+    assert sorted(os.path.basename(p) for p in ds['benign']) == ['a.png', 'b.png']
+    assert not manifest.dirty
+    assert len(DatasetManifest(manifest_path).files) == 2
+
+
+def test_manifest_rehashes_files_overwritten_in_place(tmp_path):
+    (tmp_path / 'benign').mkdir()
+    path = tmp_path / 'benign' / 'a.png'
+    path.write_bytes(b'a')
+    manifest = DatasetManifest(str(tmp_path / 'manifest.json'))
+    assert manifest.glob(str(tmp_path / 'benign' / '*.png')) == [str(path)]
+    manifest.save()
+
+    mtime_ns = os.stat(tmp_path / 'benign').st_mtime_ns
+    path.write_bytes(b'bb')
+    os.utime(tmp_path / 'benign', ns=(mtime_ns, mtime_ns))  # the directory listing is the same
+
+    manifest = DatasetManifest(str(tmp_path / 'manifest.json'))
+    assert manifest.get_hash(str(path)) == hash_file(str(path))
+    assert manifest.dirty
+
+    manifest.save()
+    assert [p.name for p in tmp_path.iterdir() if p.is_file()] == ['manifest.json']  # no temporary file left
+
+    path.write_bytes(b'ccc')
+    manifest = DatasetManifest(str(tmp_path / 'manifest.json'), verify=True)
+    assert manifest.glob(str(tmp_path / 'benign' / '*.png')) == [str(path)]  # cached listing
+    assert manifest.files[str(path)][2] == hash_file(str(path))
+
+
+def test_manifest_cached_glob_stats_the_directory_only(tmp_path, monkeypatch):
+    (tmp_path / 'benign').mkdir()
+    for name in ('a.png', 'b.png', 'c.png'):
+        (tmp_path / 'benign' / name).write_bytes(name.encode())
+    pattern = str(tmp_path / 'benign' / '*.png')
+    manifest = DatasetManifest(str(tmp_path / 'manifest.json'))
+    manifest.glob(pattern)
+    manifest.save()
+
+    manifest = DatasetManifest(str(tmp_path / 'manifest.json'))
+    stats = []
+    monkeypatch.setattr(os, 'stat', lambda path, _stat=os.stat: stats.append(path) or _stat(path))
+    assert len(manifest.glob(pattern)) == 3
+    assert stats == [str(tmp_path / 'benign')]
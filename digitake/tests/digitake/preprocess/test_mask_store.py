@@ -0,0 +1,48 @@
+import pickle
+
+import numpy as np
+from PIL import Image
+
+from src.digitake.preprocess.mask_store import MaskStore, build_mask_store
+from src.digitake.preprocess.thyroid import ThyroidDataset
+
+
+def _corner_mask(path):
+    if path.endswith('none.png'):
+        return None
+    mask = np.zeros((20, 30), dtype=bool)
+    mask[:10, :16] = True
+    return mask
+
+
+def test_mask_store_roundtrip(tmp_path):
+    prefix = str(tmp_path / 'masks')
+    index = build_mask_store(_corner_mask, ['a.png', 'none.png', 'b.png'], prefix, (10, 13))
+    assert index['paths'] == ['a.png', 'b.png']
+
+    store = pickle.loads(pickle.dumps(MaskStore(prefix)))
+    assert len(store) == 2 and 'a.png' in store and 'none.png' not in store
+    assert store.masks.shape == (2, 10, 2)  # 13 bits packed into 2 bytes
+
+    mask = store.get('b.png')
+    assert mask.shape == (10, 13) and mask.dtype == np.uint8
+    assert (mask[:5, :6] == 255).all() and mask[5:].sum() == 0 and mask[:, 7:].sum() == 0
+    assert store.get('none.png') is None
+
+
+def test_thyroid_dataset_mask_store(tmp_path):
+    paths = []
+    for name in ('a.png', 'none.png'):
+        paths.append(str(tmp_path / name))
+        Image.fromarray(np.full((20, 30, 3), 10, dtype=np.uint8)).save(paths[-1])
+
+    prefix = str(tmp_path / 'masks')
+    build_mask_store(_corner_mask, paths, prefix, (10, 15))
+
+    ds = ThyroidDataset('train', {'benign': paths}, lambda x: np.asarray(x), mask_store=MaskStore(prefix))
+    image, _, _ = ds[0]
+    assert image.shape == (20, 30, 4) and (image[..., :3] == 10).all()
+    assert (image[:10, :16, 3] == 255).all() and image[10:, :, 3].sum() == 0 and image[:, 16:, 3].sum() == 0
+
+    image, _, _ = ds[1]
+    assert image.shape == (20, 30, 4) and image[..., 3].sum() == 0
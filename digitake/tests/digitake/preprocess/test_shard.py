@@ -0,0 +1,56 @@
+import numpy as np
+from PIL import Image
+
+from src.digitake.preprocess.mask_store import MaskStore, build_mask_store
+from src.digitake.preprocess.shard import ShardDataset, build_shard
+from src.digitake.preprocess.thyroid import ThyroidDataset
+
+
+def test_shard_roundtrip(tmp_path):
+    dataset = {'malignant': [], 'benign': []}
+    for label, value in (('malignant', 200), ('benign', 10), ('benign', 20)):
+        path = str(tmp_path / f'{label}_{value}.png')
+        Image.fromarray(np.full((12, 16, 3), value, dtype=np.uint8)).save(path)
+        dataset[label].append(path)
+
+    prefix = str(tmp_path / 'train')
+    build_shard(dataset, prefix, (6, 8), meta_fn=lambda path: {'value': int(path[-7:-4].strip('_'))})
+
+    ds = ShardDataset('train', prefix, compact_extra=True)
+    assert len(ds) == 3
+    assert ds.images.shape == (3, 6, 8, 3)
+
+    image, class_index, sample_id = ds[2]
+    assert image.shape == (3, 6, 8) and (image == 200).all()
+    assert class_index == 1 and ds.get_class_label(class_index) == 'malignant'
+    assert ds.get_meta(sample_id) == {'value': 200}
+    assert ds.get_extra(1)['inclass_index'] == 1
+
+
+def _top_mask(path):
+    if path.endswith('none.png'):
+        return None
+    mask = np.zeros((12, 16), dtype=bool)
+    mask[:6] = True
+    return mask
+
+
+def test_shard_mask_store_alpha(tmp_path):
+    dataset = {'benign': [str(tmp_path / 'a.png'), str(tmp_path / 'none.png')]}
+    for path in dataset['benign']:
+        Image.fromarray(np.full((12, 16, 3), 10, dtype=np.uint8)).save(path)
+    build_mask_store(_top_mask, dataset['benign'], str(tmp_path / 'masks'), (12, 16))
+    mask_store = MaskStore(str(tmp_path / 'masks'))
+
+    prefix = str(tmp_path / 'train')
+    index = build_shard(dataset, prefix, (6, 8), mask_store=mask_store, workers=1)
+    assert index['mode'] == 'RGBA'
+
+    ds = ShardDataset('train', prefix)
+    assert ds.images.shape == (2, 6, 8, 4) and (ds.images[..., :3] == 10).all()
+    assert (ds.images[0, :3, :, 3] == 255).all() and ds.images[0, 3:, :, 3].sum() == 0  # the source mask
+    assert ds.images[1, ..., 3].sum() == 0
+
+    thyroid = ThyroidDataset('train', dataset, lambda x: np.asarray(x), mask_store=mask_store)
+    alpha = Image.fromarray(thyroid[0][0][..., 3]).resize((8, 6), Image.NEAREST)
+    assert (np.asarray(alpha) == ds.images[0, ..., 3]).all()  # the alpha ThyroidDataset serves
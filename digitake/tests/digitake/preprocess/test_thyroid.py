@@ -0,0 +1,34 @@
+from src.digitake.preprocess.thyroid import ThyroidDataset
+
+
+def test_thyroid_dataset_index():
+    ds = ThyroidDataset('test', {'malignant': ['m0', 'm1'], 'benign': ['b0', 'b1', 'b2']}, lambda x: x,
+                        compact_extra=True)
+    assert len(ds) == 5
+    assert ds.get_paths([0, 2, 4]) == ['b0', 'b2', 'm1']
+    assert ds.get_extra(3) == {'path': 'm0', 'label': 'malignant', 'class_index': 1, 'inclass_index': 0}
+
+    ds.set_dataset({'benign': ['b0'], 'malignant': ['m0']})
+    assert len(ds) == 2
+    assert ds.get_extra(1)['inclass_index'] == 0
+
+
+def test_thyroid_dataset_mask_lookup(tmp_path):
+    import numpy as np
+    from PIL import Image
+
+    image_path = str(tmp_path / 'c0001_1_p0002.png')
+    mask_path = str(tmp_path / 'mask' / 'c0001_1_p0002.png')
+    (tmp_path / 'mask').mkdir()
+    Image.fromarray(np.full((8, 8, 3), 10, dtype=np.uint8)).save(image_path)
+    Image.fromarray(np.full((8, 8), 200, dtype=np.uint8)).save(mask_path)
+
+    ds = ThyroidDataset('train', {'benign': [image_path]}, lambda x: np.asarray(x),
+                        mask_dict={'benign': [str(tmp_path / 'other.png'), mask_path]})
+    assert ds.get_mask_path(image_path, 'benign') == mask_path
+    image, _, _ = ds[0]
+    assert image.shape == (8, 8, 4) and (image[..., 3] == 200).all()
+
+    ds = ThyroidDataset('train', {'benign': [image_path]}, lambda x: np.asarray(x), mask_dict={image_path: mask_path})
+    assert ds.get_mask_path(image_path, 'benign') == mask_path
+    assert ds.get_mask_path(mask_path, 'benign') is None
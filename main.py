@@ -3,6 +3,7 @@ from wsdan.demo import test as demo_test
 from wsdan.demo import train as demo_train
 from wsdan.demo import train_with_doppler as demo_train_with_doppler
 from wsdan.digitake.preprocess import build_dataset
+from wsdan.demo.utils import get_dataset_manifest
 
 import logging
 logger = logging.getLogger('@@')
@@ -30,11 +31,11 @@ if __name__ == '__main__':
             'train': build_dataset({
                 'benign': ['Markers_Train_Remove_Markers/Benign_Remove/train'],
                 'malignant': ['Markers_Train_Remove_Markers/Malignant_Remove/train'],
-            }, root='Dataset_doppler_100e'),  # 70% + extra, 70% (doppler matched)
+            }, root='Dataset_doppler_100e', manifest=get_dataset_manifest()),  # 70% + extra, 70% (doppler matched)
             'validate': build_dataset({
                 'benign': ['Markers_Train_Remove_Markers/Benign_Remove/validate'],
                 'malignant': ['Markers_Train_Remove_Markers/Malignant_Remove/validate'],
-            }, root='Dataset_doppler_100e'),  # 30% 30% (doppler matched)
+            }, root='Dataset_doppler_100e', manifest=get_dataset_manifest()),  # 30% 30% (doppler matched)
         }
 
         #ckpt = demo_train(total_epochs, model, ds_paths)
@@ -50,7 +51,7 @@ if __name__ == '__main__':
         test_ds_path = build_dataset({
             'benign': ['Markers_Train_Remove_Markers/Benign_Remove/test'],
             'malignant': ['Markers_Train_Remove_Markers/Malignant_Remove/test'],
-        }, root='Dataset_doppler_100e')  # 75 75
+        }, root='Dataset_doppler_100e', manifest=get_dataset_manifest())  # 75 75
 
         demo_test(ckpt, model, test_ds_path)
 
@@ -65,14 +66,14 @@ if __name__ == '__main__':
         demo_test(ckpt, 'resnet34', build_dataset({
             'benign': ['Markers_Train_Remove_Markers/Benign_Remove/test'],
             'malignant': ['Markers_Train_Remove_Markers/Malignant_Remove/test'],
-        }, root='Dataset_doppler_100d'))
+        }, root='Dataset_doppler_100d', manifest=get_dataset_manifest()))
 
     if 0:  # demo - acc 0.65-0.68
         ckpt = 'WSDAN_doppler_100d-resnet34_250_8_lr-1e5_n4.ckpt'
         test_ds_path = build_dataset({
             'benign': ['Markers_Train_Remove_Markers/Benign_Remove/test'],
             'malignant': ['Markers_Train_Remove_Markers/Malignant_Remove/test'],
-        }, root='Dataset_doppler_100d')
+        }, root='Dataset_doppler_100d', manifest=get_dataset_manifest())
 
         demo_test(ckpt, 'resnet34', test_ds_path, 250, 8)
 
@@ -91,7 +92,7 @@ if __name__ == '__main__':
         kfold = build_dataset({
             'benign': ['Train/Benign', 'Val/Benign'],
             'malignant': ['Train/Malignant', 'Val/Malignant'],
-        }, root='Dataset_train_test_val')
+        }, root='Dataset_train_test_val', manifest=get_dataset_manifest())
         kfold['benign'] = kfold['benign'][0:30]
         kfold['malignant'] = kfold['malignant'][0:25]
 
@@ -110,7 +111,7 @@ if __name__ == '__main__':
         test_ds_path = build_dataset({
             'benign': ['test26/Benign'],
             'malignant': ['test26/Malignant'],
-        }, root='siriraj_original_Testset_26')
+        }, root='siriraj_original_Testset_26', manifest=get_dataset_manifest())
 
         ##demo_test('xxxx/ckpt', 'resnet34', test_ds_path)
         demo_test('densenet121_250_8_lr-1e5_n4', 'densenet121', test_ds_path)
@@ -0,0 +1,72 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/bench_bap.py cpu 5
+
+import sys
+import time
+
+import torch
+from torch.nn import functional
+
+from wsdan.net import BAP, EPSILON
+
+# num_features and feature map (H, W) of each backbone, for a 250x250 input
+BACKBONES = {
+    'resnet34': (512, 8, 8),
+    'resnet50': (2048, 8, 8),
+    'densenet121': (512, 15, 15),
+    'vgg': (512, 7, 7),
+    'inception': (768, 14, 14),
+}
+ATTENTION_MAPS = (16, 32, 64)
+BATCH_SIZE = 8
+
+
+def bap_legacy(features, attentions, pool):
+    """BAP.forward before the batched pooling and the fused epilogue"""
+    B, C, H, W = features.size()
+    M = attentions.size(1)
+    if pool == 'GAP':
+        feature_matrix = (torch.einsum('imjk,injk->imn', (attentions, features)) / float(H * W)).view(B, -1)
+    else:
+        feature_matrix = torch.cat([functional.adaptive_max_pool2d(features * attentions[:, i:i + 1, ...], 1).view(B, -1)
+                                    for i in range(M)], dim=1)
+    feature_matrix = torch.sign(feature_matrix) * torch.sqrt(torch.abs(feature_matrix) + EPSILON)
+    return functional.normalize(feature_matrix, dim=-1)
+
+
+def time_step(fn, features, attentions, device, repeats):
+    """Mean seconds of a forward plus backward"""
+    def step():
+        features.grad, attentions.grad = None, None
+        fn(features, attentions).sum().backward()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+    step()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    try:
+        device = sys.argv[1] if len(sys.argv) > 1 else 'cpu'
+        repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    except:
+        print(f'Usage: python3 {sys.argv[0]} [<device>=cpu] [<repeats>=5]')
+        exit()
+
+    torch.manual_seed(0)
+    print('backbone,M,pool,legacy_ms,bap_ms,speedup,max_abs_diff')
+    for backbone, (C, H, W) in BACKBONES.items():
+        for M in ATTENTION_MAPS:
+            features = torch.relu(torch.randn(BATCH_SIZE, C, H, W, device=device)).requires_grad_()
+            attentions = torch.relu(torch.randn(BATCH_SIZE, M, H, W, device=device)).requires_grad_()
+            for pool in ('GAP', 'GMP'):
+                bap = BAP(pool)
+                with torch.no_grad():
+                    diff = (bap_legacy(features, attentions, pool) - bap(features, attentions)).abs().max().item()
+                t_legacy = time_step(lambda f, a: bap_legacy(f, a, pool), features, attentions, device, repeats)
+                t_bap = time_step(bap, features, attentions, device, repeats)
+                print(f'{backbone},{M},{pool},{t_legacy * 1e3:.2f},{t_bap * 1e3:.2f},{t_legacy / t_bap:.2f},{diff:.2e}')
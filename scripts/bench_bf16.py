@@ -0,0 +1,89 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/bench_bf16.py resnet34 8 250 5
+# !! WSDAN_CPU_BF16=1 pipenv run python3 main.py  # to train/test in the bf16 mode
+
+import copy
+import sys
+import time
+
+import torch
+from torch.nn import functional
+
+from wsdan.net import WSDAN
+from wsdan.net.augment import batch_augment
+from wsdan.net.net_train import forward, cross_entropy_loss, center_loss
+
+NUM_CLASSES = 2
+NUM_ATTENTION_MAPS = 32
+
+
+def train_step(net, X, y, feature_center, bf16):
+    """The forwards and backward of `net_train._train`, without updating `net`"""
+    net.train()
+    net.zero_grad(set_to_none=True)
+    y_pred_raw, feature_matrix, attention_map = forward(net, X, bf16)
+    feature_center_batch = functional.normalize(feature_center[y], dim=-1)
+    with torch.no_grad():
+        crop_images = batch_augment(X, None, attention_map[:, :1], mode='crop', theta=0.85, padding_ratio=0.1)
+        drop_images = batch_augment(X, None, attention_map[:, 1:], mode='drop', theta=0.35)
+    y_pred_crop, _, _ = forward(net, crop_images, bf16)
+    y_pred_drop, _, _ = forward(net, drop_images, bf16)
+    loss = cross_entropy_loss(y_pred_raw, y) / 3. + cross_entropy_loss(y_pred_crop, y) / 3. + \
+        cross_entropy_loss(y_pred_drop, y) / 3. + center_loss(feature_matrix, feature_center_batch)
+    loss.backward()
+    return loss.item()
+
+
+def test_step(net, X, bf16):
+    """The forwards of `net_test.test`, returning the logits of the raw images and the feature matrix"""
+    net.eval()
+    with torch.no_grad():
+        y_pred_raw, feature_matrix, attention_map = forward(net, X, bf16)
+        crop_images = batch_augment(X, None, attention_map, mode='crop', theta=0.85, padding_ratio=0.05)
+        forward(net, crop_images, bf16)
+    return y_pred_raw, feature_matrix
+
+
+def time_fn(fn, steps):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    try:
+        model = sys.argv[1] if len(sys.argv) > 1 else 'resnet34'
+        batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        size = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+        steps = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    except:
+        print(f'Usage: python3 {sys.argv[0]} [<model>=resnet34] [<batch size>=8] [<size>=250] [<steps>=5]')
+        exit()
+
+    print('@@ torch:', torch.__version__, 'threads:', torch.get_num_threads(),
+          'mkldnn bf16:', torch.ops.mkldnn._is_mkldnn_bf16_supported())
+
+    torch.manual_seed(0)
+    net_fp32 = WSDAN(num_classes=NUM_CLASSES, M=NUM_ATTENTION_MAPS, model=model, pretrained=False)
+    net_bf16 = copy.deepcopy(net_fp32).to_channels_last()  # the same weights
+    feature_center = torch.zeros(NUM_CLASSES, NUM_ATTENTION_MAPS * net_fp32.num_features)
+
+    X = torch.randn(batch_size, 3, size, size)
+    y = torch.randint(0, NUM_CLASSES, (batch_size,))
+
+    # accuracy, in eval mode i.e. without the random attention sampling
+    logits_fp32, fm_fp32 = test_step(net_fp32, X, False)
+    logits_bf16, fm_bf16 = test_step(net_bf16, X, True)
+    print('@@ logits max abs diff: %.4f (fp32 max abs %.4f), argmax agreement: %.1f%%' % (
+        (logits_fp32 - logits_bf16).abs().max().item(), logits_fp32.abs().max().item(),
+        100. * (logits_fp32.argmax(1) == logits_bf16.argmax(1)).float().mean().item()))
+    print('@@ feature matrix cosine similarity: min %.5f' % functional.cosine_similarity(fm_fp32, fm_bf16).min().item())
+
+    # throughput
+    print('mode,train_images_per_s,test_images_per_s')
+    for name, net, bf16 in (('fp32', net_fp32, False), ('bf16+channels_last', net_bf16, True)):
+        t_train = time_fn(lambda: train_step(net, X, y, feature_center, bf16), steps)
+        t_test = time_fn(lambda: test_step(net, X, bf16), steps)
+        print(f'{name},{batch_size / t_train:.2f},{batch_size / t_test:.2f}')
@@ -0,0 +1,112 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/bench_doppler.py synth_doppler 200 256,512,1024 1,2,4 bench_doppler.csv
+
+import csv
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from wsdan.net.doppler import detect_doppler, detect_doppler_fast, get_bbox_doppler, resolve_crop_boxes
+from wsdan.net.doppler_index import DopplerIndex, set_doppler_index
+from wsdan.net.doppler_synth import write_synth_corpus, SYNTH_MARKERS_DIR
+
+DETECTORS = {
+    'detect_doppler': detect_doppler,
+    'detect_doppler_fast': detect_doppler_fast,
+    'detect_doppler_fast@0.5': lambda img: detect_doppler_fast(img, scale=0.5),
+}
+
+
+def bench_detector(name, detect, images, truth):
+    start_time = time.perf_counter()
+    bboxes = [detect(img) for img in images]
+    elapsed = time.perf_counter() - start_time
+
+    errors = [np.abs(np.array(bbox) - np.array(gt)).max() for bbox, gt in zip(bboxes, truth) if bbox is not None]
+    return {
+        'bench': name,
+        'fps': len(images) / elapsed,
+        'detected': sum(bbox is not None for bbox in bboxes) / len(images),
+        'bbox_err_mean': float(np.mean(errors)) if errors else float('nan'),
+        'bbox_err_max': float(np.max(errors)) if errors else float('nan'),
+    }
+
+
+def bench_index(paths, workers):
+    start_time = time.perf_counter()
+    index = DopplerIndex.build(paths, workers=workers)
+    return index, {'bench': f'DopplerIndex.build/{workers}', 'fps': len(paths) / (time.perf_counter() - start_time)}
+
+
+def bench_lookup(name, paths, size, rounds=3):
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            get_bbox_doppler(path, size)
+    return {'bench': name, 'fps': rounds * len(paths) / (time.perf_counter() - start_time)}
+
+
+def bench_resolve(root, paths_doppler, size, batch_size=8):
+    # the B-mode paths of the corpus share the file names of their doppler frames
+    paths = [os.path.join(root, SYNTH_MARKERS_DIR, os.path.basename(path)) for path in paths_doppler]
+    h, w = size
+    bbox_crop = torch.tensor([[w * 0.1, h * 0.1, w * 0.6, h * 0.6]]).repeat(batch_size, 1)
+
+    start_time = time.perf_counter()
+    for begin in range(0, len(paths) - batch_size + 1, batch_size):
+        resolve_crop_boxes(bbox_crop, paths[begin:begin + batch_size], size, {'thresh_isec_in_crop': 0.25})
+    return {'bench': 'resolve_crop_boxes', 'fps': len(paths) // batch_size * batch_size / (time.perf_counter() - start_time)}
+
+
+if __name__ == '__main__':
+    try:
+        out_dir = sys.argv[1]
+        num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        sizes = [int(v) for v in sys.argv[3].split(',')] if len(sys.argv) > 3 else [256, 512, 1024]
+        worker_counts = [int(v) for v in sys.argv[4].split(',')] if len(sys.argv) > 4 else [1, 2, 4]
+        out_csv = sys.argv[5] if len(sys.argv) > 5 else None
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <output dir> [<frames>=200] [<sizes>=256,512,1024] [<workers>=1,2,4] [<csv>]')
+        exit()
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_csv = os.path.abspath(out_csv) if out_csv is not None else None
+    os.chdir(out_dir)  # the dataset roots are relative single directories, see `get_path_doppler`
+
+    rows = []
+    for size in sizes:
+        root = f'synth_{size}'
+        truth = write_synth_corpus(root, num_frames, size, occlusion=0.05)
+        paths = sorted(truth)
+        images = [cv2.imread(path) for path in paths]
+        gts = [truth[path] for path in paths]
+
+        results = [bench_detector(name, detect, images, gts) for name, detect in DETECTORS.items()]
+        for workers in worker_counts:
+            index, result = bench_index(paths, workers)
+            results.append(result)
+
+        set_doppler_index(DopplerIndex())
+        results.append(bench_lookup('get_bbox_doppler/cold+warm', paths, (250, 250)))
+        set_doppler_index(index)
+        results.append(bench_lookup('get_bbox_doppler/indexed', paths, (250, 250)))
+        results.append(bench_resolve(root, paths, (250, 250)))
+
+        for result in results:
+            result['size'] = size
+            print('@@ size %4d  %-28s %10.1f fps' % (size, result['bench'], result['fps']) + (
+                '  detected %.3f, bbox err mean %.2f max %.2f px' % (
+                    result['detected'], result['bbox_err_mean'], result['bbox_err_max']) if 'detected' in result else ''))
+        rows.extend(results)
+
+    if out_csv is not None:
+        fields = ['size', 'bench', 'fps', 'detected', 'bbox_err_mean', 'bbox_err_max']
+        with open(out_csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        print('@@ saved -', out_csv)
@@ -0,0 +1,62 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/bench_import.py 5 bench_import.csv
+
+import csv
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    'torch',
+    'wsdan.digitake',
+    'wsdan.digitake.preprocess',
+    'wsdan.net',
+    'wsdan.net.doppler',
+    'wsdan.net.augment',
+    'wsdan.net.net_test',
+    'wsdan.net.net_train',
+    'wsdan.demo',
+]
+
+# each import runs in a fresh interpreter, timing only the import statement itself, and telling whether it loaded
+# OpenCV(cv2) as a side effect
+SNIPPET = '''
+import sys
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'cv2' in sys.modules)
+'''
+
+
+def time_import(module):
+    """
+    :return: tuple of (import time in seconds, True if `cv2` got imported)
+    """
+    out = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module)],
+                         check=True, capture_output=True, text=True).stdout
+    seconds, cv2_loaded = out.strip().splitlines()[-1].split()
+    return float(seconds), cv2_loaded == 'True'
+
+
+if __name__ == '__main__':
+    try:
+        rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+        out_csv = sys.argv[2] if len(sys.argv) > 2 else None
+    except:
+        print(f'Usage: python3 {sys.argv[0]} [<rounds>=5] [<output csv>]')
+        exit()
+
+    rows = []
+    for module in MODULES:
+        results = [time_import(module) for _ in range(rounds)]
+        times = [seconds for seconds, _ in results]
+        rows.append([module, statistics.median(times), min(times), max(times), results[0][1]])
+        print('@@ %-28s median %.3fs (min %.3fs, max %.3fs) cv2 %s' % tuple(rows[-1]))
+
+    if out_csv is not None:
+        with open(out_csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['module', 'median_s', 'min_s', 'max_s', 'cv2'])
+            writer.writerows(rows)
+        print('@@ saved -', out_csv)
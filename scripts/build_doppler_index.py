@@ -0,0 +1,29 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/build_doppler_index.py Dataset_doppler_100e doppler_index_100e.json 4
+# !! WSDAN_DOPPLER_INDEX=doppler_index_100e.json pipenv run python3 main.py
+
+import os
+import sys
+import time
+
+from wsdan.net.doppler import get_doppler_pairs
+from wsdan.net.doppler_index import DopplerIndex
+
+
+if __name__ == '__main__':
+    try:
+        root, out_json = os.path.normpath(sys.argv[1]), sys.argv[2]
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <dataset root> <output json> [<workers>=cpu_count]')
+        exit()
+
+    paths = [path for path in get_doppler_pairs(root).values() if os.path.exists(path)]
+    print('@@ doppler images:', len(paths))
+
+    start_time = time.time()
+    index = DopplerIndex.build(paths, workers=workers)
+    index.save(out_json)
+
+    failed = sum(1 for entry in index.entries.values() if entry['bbox'] is None)
+    print('@@ %s: %d bboxes (%d not detected), %.2fs' % (out_json, len(index), failed, time.time() - start_time))
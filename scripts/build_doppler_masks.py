@@ -0,0 +1,24 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/build_doppler_masks.py Dataset_doppler_100e doppler_masks_250 250 4
+# !! WSDAN_DOPPLER_MASKS=doppler_masks_250 pipenv run python3 main.py
+
+import os
+import sys
+import time
+
+from wsdan.net.doppler_masks import build_doppler_mask_store
+
+
+if __name__ == '__main__':
+    try:
+        root, prefix = os.path.normpath(sys.argv[1]), sys.argv[2]
+        size = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <dataset root> <output prefix> [<size>=250] [<workers>=cpu_count]')
+        exit()
+
+    start_time = time.time()
+    index = build_doppler_mask_store(root, prefix, size, workers=workers)
+    print('@@ %s.npy: %d masks of %s, %d bytes, %.2fs' % (
+        prefix, len(index['paths']), index['size'], os.path.getsize(f'{prefix}.npy'), time.time() - start_time))
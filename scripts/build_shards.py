@@ -0,0 +1,52 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/build_shards.py Dataset_doppler_100e shards_doppler_100e 250 4
+# !! WSDAN_DOPPLER_MASKS=doppler_masks_250 pipenv run python3 scripts/build_shards.py ...  # RGBA, the masks as alpha
+
+import os
+import sys
+import time
+
+from wsdan.digitake.preprocess import build_dataset
+from wsdan.digitake.preprocess.shard import build_shard
+from wsdan.demo.utils import get_doppler_mask_store
+from wsdan.net.doppler import get_path_doppler
+
+
+def get_ds_paths(root):
+    if os.path.basename(os.path.normpath(root)).startswith('Dataset_doppler'):
+        # e.g. 'Dataset_doppler_100e'
+        return {split: build_dataset({
+            'benign': [f'Markers_Train_Remove_Markers/Benign_Remove/{split}'],
+            'malignant': [f'Markers_Train_Remove_Markers/Malignant_Remove/{split}'],
+        }, root=root) for split in ('train', 'validate', 'test')}
+    else:
+        # e.g. 'Dataset_train_test_val'
+        return {split.lower(): build_dataset({
+            'benign': [f'{split}/Benign'],
+            'malignant': [f'{split}/Malignant'],
+        }, root=root) for split in ('Train', 'Val', 'Test')}
+
+
+def get_meta(path):
+    return {'path_doppler': get_path_doppler(path)}
+
+
+if __name__ == '__main__':
+    try:
+        root, out_dir = sys.argv[1], sys.argv[2]
+        size = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <dataset root> <output dir> [<size>=250] [<workers>=cpu_count]')
+        exit()
+
+    os.makedirs(out_dir, exist_ok=True)
+    mask_store = get_doppler_mask_store()
+    print('@@ mask_store:', mask_store.prefix if mask_store is not None else None)
+
+    for split, ds_path in get_ds_paths(root).items():
+        print(f'@@ split: {split} lens:', len(ds_path['benign']), len(ds_path['malignant']))
+        prefix = os.path.join(out_dir, split)
+        start_time = time.time()
+        index = build_shard(ds_path, prefix, size, meta_fn=get_meta, mask_store=mask_store, workers=workers)
+        print('@@ %s.{npy,json}: %d samples, %.2fs' % (prefix, len(index['paths']), time.time() - start_time))
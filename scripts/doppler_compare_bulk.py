@@ -0,0 +1,32 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/doppler_compare_bulk.py Siriraj_sample_doppler_comp comp_report.csv 4 50
+
+import os
+import sys
+import time
+
+from wsdan.net.doppler_compare import get_compare_triples, compare_bulk
+
+
+if __name__ == '__main__':
+    try:
+        root, report_path = os.path.normpath(sys.argv[1]), sys.argv[2]
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+        plot_every = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <root> <report .csv/.parquet> [<workers>=cpu_count] [<plot every>=0]')
+        exit()
+
+    triples = get_compare_triples(root)
+    print('@@ pairs:', len(triples))
+
+    plot_dir = None
+    if plot_every > 0:
+        plot_dir = os.path.splitext(report_path)[0] + '_plots'
+        os.makedirs(plot_dir, exist_ok=True)
+
+    start_time = time.time()
+    summary = compare_bulk(triples, report_path, workers=workers, plot_every=plot_every, plot_dir=plot_dir)
+    print('@@ %s: %.2fs' % (report_path, time.time() - start_time))
+    for key, val in summary.items():
+        print(f'@@ {key}: {val}')
@@ -0,0 +1,59 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/doppler_parity.py Dataset_doppler_100e 0.5
+
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from wsdan.net.doppler import detect_doppler, detect_doppler_fast
+
+
+def get_doppler_paths(root):
+    paths = glob.glob(f'{root}/**/Doppler_Train_Crop/**/*.png', recursive=True) + \
+        glob.glob(f'{root}/Doppler_Train_Crop/**/*.png', recursive=True)
+    return sorted(set(paths))
+
+
+if __name__ == '__main__':
+    try:
+        roots = sys.argv[1].split(',')
+        scale = float(sys.argv[2]) if len(sys.argv) > 2 else 1.
+        tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else 0.
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <root>[,<root>...] [<scale>=1.0] [<tolerance px>=0]')
+        exit()
+
+    paths = [path for root in roots for path in get_doppler_paths(os.path.normpath(root))]
+    print('@@ doppler images:', len(paths))
+
+    time_ref, time_fast, mismatches, max_diff = 0., 0., [], 0.
+    for path in paths:
+        img = cv2.imread(path)
+
+        start_time = time.perf_counter()
+        bbox_ref = detect_doppler(img)
+        time_ref += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        bbox_fast = detect_doppler_fast(img, scale=scale)
+        time_fast += time.perf_counter() - start_time
+
+        if bbox_ref is None or bbox_fast is None:
+            if bbox_ref is not bbox_fast:
+                mismatches.append((path, bbox_ref, bbox_fast))
+            continue
+        diff = float(np.abs(np.array(bbox_ref) - np.array(bbox_fast)).max())
+        max_diff = max(max_diff, diff)
+        if diff > tolerance:
+            mismatches.append((path, bbox_ref, bbox_fast))
+
+    for path, bbox_ref, bbox_fast in mismatches:
+        print(f'@@ MISMATCH {path}: {bbox_ref} vs {bbox_fast}')
+    print('@@ scale: %g, matched: %d / %d, max diff: %.1f px' % (
+        scale, len(paths) - len(mismatches), len(paths), max_diff))
+    print('@@ detect_doppler: %.3fs, detect_doppler_fast: %.3fs (x%.1f)' % (
+        time_ref, time_fast, time_ref / max(time_fast, 1e-9)))
@@ -0,0 +1,25 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/export_doppler_pairs.py Dataset_doppler_100e  # -> Dataset_doppler_100e/doppler_pairs.csv
+
+import csv
+import os
+import sys
+
+from wsdan.net.doppler import get_doppler_pairs
+
+
+if __name__ == '__main__':
+    try:
+        root = os.path.normpath(sys.argv[1])
+        out_csv = sys.argv[2] if len(sys.argv) > 2 else os.path.join(root, 'doppler_pairs.csv')
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <dataset root> [<output csv>=<dataset root>/doppler_pairs.csv]')
+        exit()
+
+    pairs = sorted((bmode, doppler) for bmode, doppler in get_doppler_pairs(root).items()
+                   if bmode.startswith(f'{root}/'))
+    with open(out_csv, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['# bmode', 'doppler'])  # paths relative to the dataset root
+        writer.writerows([os.path.relpath(bmode, root), os.path.relpath(doppler, root)] for bmode, doppler in pairs)
+    print(f'@@ {out_csv}: {len(pairs)} pairs')
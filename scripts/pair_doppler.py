@@ -0,0 +1,27 @@
+# !! pipenv run python3 -m pip install --force-reinstall .  # for `import wsdan` to work
+# !! pipenv run python3 scripts/pair_doppler.py Dataset_doppler_100e  # -> Dataset_doppler_100e/doppler_pairs.csv
+
+import os
+import sys
+import time
+
+from wsdan.net.doppler_pairing import pair_dataset, save_pairs
+
+
+if __name__ == '__main__':
+    try:
+        root = os.path.normpath(sys.argv[1])
+        out_csv = sys.argv[2] if len(sys.argv) > 2 else os.path.join(root, 'doppler_pairs.csv')
+        max_distance = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+    except:
+        print(f'Usage: python3 {sys.argv[0]} <dataset root> [<output csv>=<dataset root>/doppler_pairs.csv] '
+              '[<max distance>=12] [<workers>=cpu count]')
+        exit()
+
+    t0 = time.time()
+    pairs = pair_dataset(root, max_distance=max_distance, workers=workers)
+    save_pairs(pairs, root, out_csv)
+    distances = sorted(distance for _, distance in pairs.values())
+    print(f'@@ {out_csv}: {len(pairs)} pairs in {time.time() - t0:.2f}s'
+          + (f', median distance {distances[len(distances) // 2]}' if distances else ''))
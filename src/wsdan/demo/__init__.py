@@ -1,35 +1,40 @@
+import functools
+import os
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 
-from ..digitake.preprocess import build_dataset
+from ..digitake.preprocess import build_dataset, SharedImageCache
 
-from ..net import WSDAN, net_train, net_test
+from ..net import WSDAN
 
 from .transform import ThyroidDataset, get_transform##, get_transform_center_crop, transform_fn
-from .utils import mk_artifact_dir, get_device
+from .transform import BatchTransformLoader, get_batch_transform
+from .utils import mk_artifact_dir, get_device, get_dataset_manifest, get_doppler_mask_store, get_cpu_bf16
+from .utils import get_image_cache_bytes, get_batch_device
 
 
 WSDAN_NUM_CLASSES = 2
 
-TRAIN_DS_PATH_DEFAULT = build_dataset({
-    'benign': ['Train/Benign'],
-    'malignant': ['Train/Malignant'],
-}, root='Dataset_train_test_val')  # 21 20
-
-VALIDATE_DS_PATH_DEFAULT = build_dataset({
-    'benign': ['Val/Benign'],
-    'malignant': ['Val/Malignant'],
-}, root='Dataset_train_test_val')  # 10 10
-
-TEST_DS_PATH_DEFAULT = build_dataset({
-    'benign': ['Test/Benign'],
-    'malignant': ['Test/Malignant'],
-}, root='Dataset_train_test_val')  # 10 10
+# the default datasets are globbed on first access of `TRAIN_DS_PATH_DEFAULT` etc., not on import
+DEFAULT_DS_PATH_DIRS = {
+    'TRAIN_DS_PATH_DEFAULT': 'Train',  # 21 20
+    'VALIDATE_DS_PATH_DEFAULT': 'Val',  # 10 10
+    'TEST_DS_PATH_DEFAULT': 'Test',  # 10 10
+}
 
 TOTAL_EPOCHS_DEFAULT = 100
 MODEL_DEFAULT = 'densenet121'
 
-print("@@ torch.__version__:", torch.__version__)
+
+def __getattr__(name):
+    if name in DEFAULT_DS_PATH_DIRS:
+        split = DEFAULT_DS_PATH_DIRS[name]
+        globals()[name] = build_dataset({
+            'benign': [f'{split}/Benign'],
+            'malignant': [f'{split}/Malignant'],
+        }, root='Dataset_train_test_val', manifest=get_dataset_manifest())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def doppler_compare():
@@ -58,6 +63,19 @@ def doppler_compare():
         print('@@ saved -', fname)
 
 
+def doppler_compare_bulk(root='Siriraj_sample_doppler_comp', workers=None, plot_every=0):
+    from ..net.doppler_compare import get_compare_triples, compare_bulk
+    savepath = mk_artifact_dir('demo_doppler_comp_bulk')
+
+    triples = get_compare_triples(root)
+    print('@@ doppler_compare_bulk(): pairs:', len(triples))
+
+    summary = compare_bulk(triples, f'{savepath}/report.csv', workers=workers or os.cpu_count(),
+                           plot_every=plot_every, plot_dir=savepath)
+    print('@@ summary:', summary)
+    return summary
+
+
 # >>> m = [1, 2, 3, 4, 5]
 # >>> slice_split(m, slice(2, 4))
 # ([3, 4], [1, 2, 5])
@@ -67,31 +85,54 @@ def slice_split(li_in_const, slice_in):
     del li_out[slice_in]
     return li_out_sliced, li_out
 
-def create_train_loader(train_ds_path, target_resize, batch_size, workers, with_doppler=False):
-    #----!!!!
-    from wsdan.net.doppler import get_to_doppler
-    dataset_doppler_root = train_ds_path['benign'][0].split('/')[0]
-    #print('@@ dataset_doppler_root:', dataset_doppler_root)
-    #----!!!!
+def create_image_cache(ds_path, target_resize, cache_bytes, channels=3):
+    if not cache_bytes:
+        return None
+    return SharedImageCache(sum(len(v) for v in ds_path.values()), target_resize, cache_bytes, channels)
+
+def get_worker_options(workers, prefetch_factor):
+    """DataLoader options keeping the worker processes alive across epochs, instead of respawning them per epoch"""
+    if workers == 0:
+        return {'num_workers': 0}
+    return {'num_workers': workers, 'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+
+def create_train_loader(train_ds_path, target_resize, batch_size, workers, with_doppler=False, cache_bytes=0,
+                        batch_device=None, prefetch_factor=2, mask_store=None, sampler=None):
+    # with `mask_store`, the images are RGBA, the alpha channel being the precomputed(doppler) mask
+    with_alpha_channel = mask_store is not None
+
+    if batch_device is not None:  # workers only emit uint8 tensors, the rest runs on `batch_device`
+        transform, batch_transform = get_batch_transform(target_resize, phase='basic',
+                                                         with_alpha_channel=with_alpha_channel)
+    else:
+        transform, batch_transform = get_transform(target_resize, phase='basic',
+                                                   with_alpha_channel=with_alpha_channel), None
+
+    if with_doppler:  # the workers also resolve the doppler bboxes, scaled to the network input
+        from ..net.doppler_dataset import DopplerThyroidDataset
+        dataset_cls = functools.partial(DopplerThyroidDataset, bbox_size=target_resize)
+    else:
+        dataset_cls = ThyroidDataset
 
-    train_dataset = ThyroidDataset(
+    train_dataset = dataset_cls(
         phase='train',
         dataset=train_ds_path,
-        transform=get_transform(target_resize, phase='basic'),
-    #==== @@ orig
-        with_alpha_channel=False  # if False, it will load image as RGB(3-channel)
-    #==== @@ WIP w.r.t. 'digitake/preprocess/thyroid.py'
-        # mask_dict=get_to_doppler(dataset_doppler_root) if with_doppler else None,  # !!!!
-        # with_alpha_channel=with_doppler  # !!!! TODO debug with `True`
-    #====
-    )
+        transform=transform,
+        with_alpha_channel=with_alpha_channel,  # if False, it will load image as RGB(3-channel)
+        cache=create_image_cache(train_ds_path, target_resize, cache_bytes, 4 if with_alpha_channel else 3),
+        compact_extra=True,
+        mask_store=mask_store)  # no mask image decoded, cf. `mask_dict=get_to_doppler(...)`
 
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
-        num_workers=workers,
-        pin_memory=True)
+        shuffle=sampler is None,
+        sampler=sampler,  # e.g. a FoldSampler shuffling the current fold only
+        pin_memory=True,
+        **get_worker_options(workers, prefetch_factor))
+
+    if batch_transform is not None:
+        train_loader = BatchTransformLoader(train_loader, batch_transform, batch_device)
 
     if 0:
         print('@@ show_data_loader(train_loader) -------- ^^')
@@ -100,26 +141,151 @@ def create_train_loader(train_ds_path, target_resize, batch_size, workers, with_
 
     return train_loader
 
-def create_validate_loader(validate_ds_path, target_resize, batch_size, workers):
+def create_validate_loader(validate_ds_path, target_resize, batch_size, workers, cache_bytes=0,
+                           batch_device=None, prefetch_factor=2, mask_store=None, sampler=None):
+    with_alpha_channel = mask_store is not None
+
+    if batch_device is not None:
+        transform, batch_transform = get_batch_transform(target_resize, phase='basic',
+                                                         with_alpha_channel=with_alpha_channel)
+    else:
+        transform, batch_transform = get_transform(target_resize, phase='basic',
+                                                   with_alpha_channel=with_alpha_channel), None
+
     validate_dataset = ThyroidDataset(
         phase='val',
         dataset=validate_ds_path,
-        transform=get_transform(target_resize, phase='basic'),
-        with_alpha_channel=False)
+        transform=transform,
+        with_alpha_channel=with_alpha_channel,
+        cache=create_image_cache(validate_ds_path, target_resize, cache_bytes, 4 if with_alpha_channel else 3),
+        compact_extra=True,
+        mask_store=mask_store)
 
-    return DataLoader(
+    validate_loader = DataLoader(
         validate_dataset,
         batch_size=batch_size * 4,
         shuffle=False,
-        num_workers=workers,
-        pin_memory=True)
+        sampler=sampler,
+        pin_memory=True,
+        **get_worker_options(workers, prefetch_factor))
+
+    if batch_transform is not None:
+        validate_loader = BatchTransformLoader(validate_loader, batch_transform, batch_device)
+
+    return validate_loader
+
+
+class FoldSampler(Sampler):
+    """
+    Sampler over the subset of the dataset indices set by `set_indices`
+
+    It runs in the main process, so swapping the subset between the epochs reaches the persistent workers of its
+    DataLoader, which a dataset mutated in the main process wouldn't.
+    """
+
+    def __init__(self, shuffle=False):
+        self.shuffle = shuffle
+        self.indices = []
+
+    def set_indices(self, indices):
+        self.indices = list(indices)
+
+    def __iter__(self):
+        if self.shuffle:
+            return iter([self.indices[i] for i in torch.randperm(len(self.indices)).tolist()])
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class KFoldLoaders:
+    """
+    The (train_loader, validate_loader) of each fold, as indexed by `net_train.train`, all being a single pair of
+    loaders over the paths of every fold: getting the k-th fold swaps its indices into their FoldSampler-s, so the
+    worker pools and the image caches are shared by the folds instead of being created for each of them
+    """
+
+    def __init__(self, kfold_ds_paths, create_loaders):
+        """
+        :param kfold_ds_paths: list of tuple of (train ds_path, validate ds_path)
+        :param create_loaders: function of (ds_path, train sampler, validate sampler) returning the tuple of
+                               (train_loader, validate_loader) over `ds_path`
+        """
+        ds_path = {}  # the paths of every fold, each once
+        for tv_ds_path in kfold_ds_paths:
+            for fold_ds_path in tv_ds_path:
+                for label, paths in fold_ds_path.items():
+                    ds_path.setdefault(label, {}).update(dict.fromkeys(paths))
+        ds_path = {label: list(paths) for label, paths in ds_path.items()}
+
+        self.train_sampler = FoldSampler(shuffle=True)
+        self.validate_sampler = FoldSampler()
+        self.loaders = create_loaders(ds_path, self.train_sampler, self.validate_sampler)
+
+        index = {path: i for i, path in enumerate(self.loaders[0].dataset.paths)}
+        self.fold_indices = [
+            tuple([index[path] for label in sorted(fold_ds_path) for path in fold_ds_path[label]]
+                  for fold_ds_path in tv_ds_path)
+            for tv_ds_path in kfold_ds_paths]
+
+    def __len__(self):
+        return len(self.fold_indices)
+
+    def __getitem__(self, k):
+        train_indices, validate_indices = self.fold_indices[k]
+        self.train_sampler.set_indices(train_indices)
+        self.validate_sampler.set_indices(validate_indices)
+        return self.loaders
+
+
+def get_tune_step_fn(net, device):
+    """A stand-in for a train step of `net`, i.e. the raw, crop and drop forwards plus backward, not updating `net`"""
+    def step_fn(batch):
+        X = batch[0].to(device)
+        net.eval()  # keep the batchnorm running stats
+        net.zero_grad(set_to_none=True)
+        loss = sum(net(X)[0].sum() for _ in range(3))
+        loss.backward()
+        loss.item()  # sync the device
+        net.zero_grad(set_to_none=True)
+    return step_fn
+
+def tune_loader_workers(create_loader, step_fn, worker_counts=(0, 1, 2, 4, 8), prefetch_factors=(2, 4),
+                        num_batches=10, max_wait_ratio=0.05):
+    """
+    Pick the fewest workers, then the shallowest prefetch, that keep the data wait under `max_wait_ratio` of a step
+    :param create_loader: function of (workers, prefetch_factor) returning a DataLoader
+    :param step_fn: function consuming a batch, e.g. `get_tune_step_fn(net, device)`
+    :return: tuple of (workers, prefetch_factor)
+    """
+    from ..net.net_train import measure_data_wait
+
+    worker_counts = [w for w in worker_counts if w <= (os.cpu_count() or 1)]
+    results = []
+    for workers in worker_counts:
+        for prefetch_factor in (prefetch_factors if workers > 0 else prefetch_factors[:1]):
+            loader = create_loader(workers, prefetch_factor)
+            data_wait, step_time = measure_data_wait(loader, step_fn, num_batches)
+            del loader  # shut the workers down
+            ratio = data_wait / max(data_wait + step_time, 1e-9)
+            print('@@ tune_loader_workers(): workers=%d prefetch_factor=%d data_wait=%.3fs step=%.3fs (%.1f%%)' % (
+                workers, prefetch_factor, data_wait, step_time, ratio * 100))
+            results.append((ratio, workers, prefetch_factor))
+
+    saturated = [r for r in results if r[0] <= max_wait_ratio]
+    if saturated:
+        _, workers, prefetch_factor = min(saturated, key=lambda r: (r[1], r[2]))
+    else:
+        _, workers, prefetch_factor = min(results)
+    return workers, prefetch_factor
 
 
 def kfold_ds_paths_debug_v1():  # hardcoded w.r.t. 'Dataset_train_test_val.zip'
     mix_ds_path  = build_dataset({
         'benign': ['Train/Benign', 'Val/Benign'],
         'malignant': ['Train/Malignant', 'Val/Malignant'],
-    }, root='Dataset_train_test_val')  # 30 30
+    }, root='Dataset_train_test_val', manifest=get_dataset_manifest())  # 30 30
     print("@@ lens trainval_ds_path:", len(mix_ds_path['benign']), len(mix_ds_path['malignant']))
 
     # fold 0
@@ -182,7 +348,7 @@ def kfold_ds_paths_debug_v2():  # hardcoded w.r.t. 'Dataset_train_test_val.zip'
     mix_ds_path  = build_dataset({
         'benign': ['Train/Benign', 'Val/Benign'],
         'malignant': ['Train/Malignant', 'Val/Malignant'],
-    }, root='Dataset_train_test_val')  # 30 30
+    }, root='Dataset_train_test_val', manifest=get_dataset_manifest())  # 30 30
     print("@@ lens trainval_ds_path:", len(mix_ds_path['benign']), len(mix_ds_path['malignant']))
 
     return [slice_mix_ds_path(mix_ds_path, slice_v)
@@ -190,6 +356,9 @@ def kfold_ds_paths_debug_v2():  # hardcoded w.r.t. 'Dataset_train_test_val.zip'
 
 
 def _train(with_doppler, total_epochs, model, ds_paths, savepath, config_doppler=None):
+    from ..net import net_train
+
+    print("@@ torch.__version__:", torch.__version__)
     device = get_device()
     print("@@ device:", device)
 
@@ -213,7 +382,18 @@ def _train(with_doppler, total_epochs, model, ds_paths, savepath, config_doppler
     number = 4 #@param ["1", "2", "3", "4", "5"] {type:"raw", allow-input: true}
 
     workers = 2
-    print('@@ workers:', workers)
+    prefetch_factor = 2
+    tune_workers = os.environ.get('WSDAN_TUNE_WORKERS') == '1'  # if '1', pick `workers` and `prefetch_factor` by measuring
+    print('@@ tune_workers:', tune_workers)
+
+    cache_bytes = get_image_cache_bytes()  # e.g. WSDAN_IMAGE_CACHE_BYTES=2147483648 for up to 2 GiB per loader
+    print('@@ cache_bytes:', cache_bytes)
+
+    batch_device = get_batch_device(device)  # if WSDAN_BATCH_TRANSFORM=1, the transform runs batched on `device`
+    print('@@ batch_device:', batch_device)
+
+    mask_store = get_doppler_mask_store() if with_doppler else None  # if set, train on RGB + doppler mask
+    print('@@ mask_store:', mask_store.prefix if mask_store is not None else None)
 
     lr = 0.001 #@param ["0.001", "0.00001"] {type:"raw"}
     lr_ = "lr-1e5" #@param ["lr-1e3", "lr-1e5"]
@@ -263,20 +443,35 @@ def _train(with_doppler, total_epochs, model, ds_paths, savepath, config_doppler
             ##exit()  # !!!!
         #====
 
-    kfold_loaders = [(
-        create_train_loader(tv_ds_path[0], target_resize, batch_size, workers, with_doppler),
-        create_validate_loader(tv_ds_path[1], target_resize, batch_size, workers))
-        for tv_ds_path in kfold_ds_paths]
-
-    #
-
     num_attention_maps = 32  # @@ cf. 16 in 'main_legacy.py'
-    net = WSDAN(num_classes=WSDAN_NUM_CLASSES, M=num_attention_maps, model=model, pretrained=True)
+    net = WSDAN(num_classes=WSDAN_NUM_CLASSES, M=num_attention_maps, model=model, pretrained=True,
+                in_channels=4 if mask_store is not None else 3)
     net.to(device)
+    bf16 = get_cpu_bf16(device)  # if True, bfloat16 autocast and channels-last, see 'scripts/bench_bf16.py'
+    print('@@ bf16:', bf16)
+    if bf16:
+        net = net.to_channels_last()
     feature_center = torch.zeros(WSDAN_NUM_CLASSES, num_attention_maps * net.num_features).to(device)
 
     #
 
+    if tune_workers:
+        workers, prefetch_factor = tune_loader_workers(
+            lambda w, pf: create_train_loader(kfold_ds_paths[0][0], target_resize, batch_size, w, with_doppler,
+                                              cache_bytes, batch_device, pf, mask_store),
+            get_tune_step_fn(net, device))
+    print('@@ workers:', workers)
+    print('@@ prefetch_factor:', prefetch_factor)
+
+    # with persistent workers, each loader spawns its pool once and reuses it for every epoch and fold
+    kfold_loaders = KFoldLoaders(kfold_ds_paths, lambda ds_path, train_sampler, validate_sampler: (
+        create_train_loader(ds_path, target_resize, batch_size, workers, with_doppler, cache_bytes,
+                            batch_device, prefetch_factor, mask_store, train_sampler),
+        create_validate_loader(ds_path, target_resize, batch_size, workers, cache_bytes, batch_device,
+                               prefetch_factor, mask_store, validate_sampler)))
+
+    #
+
     logs = {
         'epoch': 0,
         'train/loss': float("Inf"),
@@ -319,7 +514,7 @@ def _train(with_doppler, total_epochs, model, ds_paths, savepath, config_doppler
     ckpt = net_train.train(
         device, net, feature_center, batch_size, kfold_loaders,
         optimizer, scheduler, run_name, logs, START_EPOCH, total_epochs,
-        with_doppler=with_doppler, config_doppler=config_doppler, savepath=savepath)
+        with_doppler=with_doppler, config_doppler=config_doppler, savepath=savepath, bf16=bf16)
     print('@@ done; ckpt:', ckpt)
 
     return ckpt
@@ -328,29 +523,39 @@ def _train(with_doppler, total_epochs, model, ds_paths, savepath, config_doppler
 def train(
         total_epochs=TOTAL_EPOCHS_DEFAULT,
         model=MODEL_DEFAULT,
-        ds_paths={'train': TRAIN_DS_PATH_DEFAULT, 'validate': VALIDATE_DS_PATH_DEFAULT}):
+        ds_paths=None):
+    if ds_paths is None:
+        ds_paths = {'train': __getattr__('TRAIN_DS_PATH_DEFAULT'), 'validate': __getattr__('VALIDATE_DS_PATH_DEFAULT')}
     return _train(False, total_epochs, model, ds_paths, mk_artifact_dir('demo_train'))
 
 
 def train_with_doppler(
         total_epochs=TOTAL_EPOCHS_DEFAULT,
         model=MODEL_DEFAULT,
-        ds_paths={'train': TRAIN_DS_PATH_DEFAULT, 'validate': VALIDATE_DS_PATH_DEFAULT},
+        ds_paths=None,
         config_doppler={
             'thresh_isec_in_crop': 0.25,  # default
             #'thresh_isec_in_crop': 0.50,
             #'thresh_isec_in_crop': 0.75,
             #'thresh_force_doppler_in_crop': True,
         }):
+    if ds_paths is None:
+        ds_paths = {'train': __getattr__('TRAIN_DS_PATH_DEFAULT'), 'validate': __getattr__('VALIDATE_DS_PATH_DEFAULT')}
     return _train(True, total_epochs, model, ds_paths, mk_artifact_dir('demo_train_with_doppler'),
                   config_doppler=config_doppler)
 
 
-def test(ckpt, model=MODEL_DEFAULT, ds_path=TEST_DS_PATH_DEFAULT,
-        target_resize=250, batch_size=8, num_attention_maps=32, auc=False, tag=''):
+def test(ckpt, model=MODEL_DEFAULT, ds_path=None,
+        target_resize=250, batch_size=8, num_attention_maps=32, auc=False, tag='', workers=2, mask_store=None):
+    from ..net import net_test
     from .utils import show_data_loader
     from .stats import print_scores, print_auc, print_poa
 
+    if ds_path is None:
+        ds_path = __getattr__('TEST_DS_PATH_DEFAULT')
+
+    print("@@ torch.__version__:", torch.__version__)
+
     print("@@ model:", model)
     print("@@ target_resize:", target_resize)
     print("@@ batch_size:", batch_size)
@@ -361,30 +566,36 @@ def test(ckpt, model=MODEL_DEFAULT, ds_path=TEST_DS_PATH_DEFAULT,
     #print('@@ ds_path:', ds_path)
     print("@@ lens ds_path:", len(ds_path['benign']), len(ds_path['malignant']))
 
+    with_alpha_channel = mask_store is not None  # i.e. a checkpoint trained with `WSDAN_DOPPLER_MASKS`
     test_dataset = ThyroidDataset(
         phase='test',
         dataset=ds_path,
-        transform=get_transform(target_resize, phase='basic'),
-        with_alpha_channel=False)
+        transform=get_transform(target_resize, phase='basic', with_alpha_channel=with_alpha_channel),
+        with_alpha_channel=with_alpha_channel,
+        compact_extra=True,
+        mask_store=mask_store)
 
-    #@@workers = 2
-    workers = 0  # @@
     print('@@ workers:', workers)
 
-    test_loader = DataLoader(
+    test_loader = DataLoader(  # streamed in micro-batches of `batch_size`, decoded by `workers` processes
         test_dataset,
-        batch_size=len(test_dataset),  # @@
+        batch_size=batch_size,
         shuffle=False,
         num_workers=workers,
         pin_memory=True)
 
     #
 
-    net = WSDAN(num_classes=WSDAN_NUM_CLASSES, M=num_attention_maps, model=model, pretrained=True)
+    net = WSDAN(num_classes=WSDAN_NUM_CLASSES, M=num_attention_maps, model=model, pretrained=True,
+                in_channels=4 if with_alpha_channel else 3)
     net.to(device)
+    bf16 = get_cpu_bf16(device)
+    print('@@ bf16:', bf16)
+    if bf16:
+        net = net.to_channels_last()
 
     sp = mk_artifact_dir(f'demo_thyroid_test_{tag}')
-    results = net_test.test(device, net, batch_size, test_loader, ckpt, savepath=sp)
+    results = net_test.test(device, net, batch_size, test_loader, ckpt, savepath=sp, bf16=bf16)
     # print('@@ results:', results)
 
     if 1:
@@ -1,5 +1,7 @@
 #@@from ..digitake.preprocess import ThyroidDataset, build_train_validation_set, get_transform, imagenet_mean, imagenet_std
-from ..digitake.preprocess import ThyroidDataset, imagenet_mean, imagenet_std
+from ..digitake.preprocess import ThyroidDataset, imagenet_mean, imagenet_std, mask_mean, mask_std
+from ..digitake.preprocess import BatchTransformLoader
+from ..digitake.preprocess import get_batch_transform as _get_batch_transform
 
 from torchvision import transforms
 
@@ -19,11 +21,12 @@ transform_basic = transforms.Compose([
                 imagenet_normalize
             ])
 
-def get_transform(target_size, phase='train'):
+def get_transform(target_size, phase='train', with_alpha_channel=False):
     """
     Predefined transformation pipe for the dataset
     :param target_size: tuple of (W,H) result image from the pipe
     :param phase: train/val/test phase of different transformation e.g. test will not need RandomCrop
+    :param with_alpha_channel: if True, normalize RGBA images, the alpha channel being a mask
     :return: a transformation function to target_size
     """
     # check target_size
@@ -35,7 +38,10 @@ def get_transform(target_size, phase='train'):
     enlarge = transforms.Resize(size=(int(target_size[0] * 1.1), int(target_size[1] * 1.1)))
 
     # ImageNet normalizer
-    imagenet_normalize = transforms.Normalize(mean=imagenet_mean, std=imagenet_std)
+    if with_alpha_channel:
+        imagenet_normalize = transforms.Normalize(mean=imagenet_mean + mask_mean, std=imagenet_std + mask_std)
+    else:
+        imagenet_normalize = transforms.Normalize(mean=imagenet_mean, std=imagenet_std)
 
     # Compose
     transform_dict = {
@@ -81,6 +87,19 @@ def get_transform(target_size, phase='train'):
         raise Exception("Unknown phase specified")
 
 
+def get_batch_transform(target_size, phase='train', with_alpha_channel=False):
+    """
+    Batched counterpart of `get_transform`, see `digitake.preprocess.get_batch_transform`
+    :param phase: basic/train/val/test phase as in `get_transform`, test being the enlarged image without cropping
+    :return: tuple of (worker transform, BatchTransform for the collated batch on the compute device)
+    """
+    if phase == 'test':  # i.e. only resized, to the enlarged size
+        if type(target_size) is int:
+            target_size = (target_size, target_size)
+        phase, target_size = 'basic', (int(target_size[0] * 1.1), int(target_size[1] * 1.1))
+    return _get_batch_transform(target_size, phase, with_alpha_channel)
+
+
 def get_transform_center_crop(target_size, scaling_factor=1.0):
   """
   Produce the centercropimage with the specific target_size.
@@ -93,12 +112,20 @@ def get_transform_center_crop(target_size, scaling_factor=1.0):
   ])
 
 
-# Define the dictionary of transform functions
-transform_fn = {
-    # 'basic': transform_basic,
-    'basic': get_transform(target_size=target_size, phase='basic'),
-    'center_crop': get_transform_center_crop(target_size=target_size, scaling_factor=1.3),
-    'train': get_transform(target_size=target_size),
-    'val': get_transform(target_size=target_size, phase='val'),
-    'test': get_transform(target_size=target_size, phase='test'),
-}
+# Define the dictionary of transform functions, built on first access of `transform_fn`
+def get_transform_fn():
+    return {
+        # 'basic': transform_basic,
+        'basic': get_transform(target_size=target_size, phase='basic'),
+        'center_crop': get_transform_center_crop(target_size=target_size, scaling_factor=1.3),
+        'train': get_transform(target_size=target_size),
+        'val': get_transform(target_size=target_size, phase='val'),
+        'test': get_transform(target_size=target_size, phase='test'),
+    }
+
+
+def __getattr__(name):
+    if name == 'transform_fn':
+        globals()['transform_fn'] = get_transform_fn()
+        return globals()['transform_fn']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -26,6 +26,44 @@ def get_device():
 
     return device
 
+def get_cpu_bf16(device):
+    """True if `WSDAN_CPU_BF16` is '1' and `device` is cpu, i.e. run WSDAN under bfloat16 autocast and channels-last"""
+    return device == 'cpu' and os.environ.get('WSDAN_CPU_BF16') == '1'
+
+def get_image_cache_bytes():
+    """The per-loader budget of the decoded image cache, `WSDAN_IMAGE_CACHE_BYTES` if set, else 0(no cache)"""
+    return int(os.environ.get('WSDAN_IMAGE_CACHE_BYTES', 0))
+
+def get_batch_device(device):
+    """
+    `device` if `WSDAN_BATCH_TRANSFORM` is '1', i.e. the workers emit uint8 tensors and the transform runs batched on
+    `device`, else None
+    """
+    return device if os.environ.get('WSDAN_BATCH_TRANSFORM') == '1' else None
+
+_dataset_manifest = None
+
+def get_dataset_manifest():
+    global _dataset_manifest
+    path = os.environ.get('WSDAN_DATASET_MANIFEST')  # e.g. 'dataset_manifest.json'
+    if path is None:
+        return None
+    if _dataset_manifest is None or _dataset_manifest.path != path:
+        _dataset_manifest = digitake.preprocess.DatasetManifest(path)
+    return _dataset_manifest
+
+_doppler_mask_store = None
+
+def get_doppler_mask_store():
+    """The MaskStore at the `WSDAN_DOPPLER_MASKS` prefix if set, serving the doppler masks as a 4th channel"""
+    global _doppler_mask_store
+    prefix = os.environ.get('WSDAN_DOPPLER_MASKS')  # e.g. 'doppler_masks_250', see 'scripts/build_doppler_masks.py'
+    if prefix is None:
+        return None
+    if _doppler_mask_store is None or _doppler_mask_store.prefix != prefix:
+        _doppler_mask_store = digitake.preprocess.MaskStore(prefix)
+    return _doppler_mask_store
+
 def show_data_loader(data_loader, plt_show=False):
     x = enumerate(data_loader)
 
@@ -42,8 +80,11 @@ def show_data_loader(data_loader, plt_show=False):
         print(f"X contains {batch_size} images with {channel}-channels of size {w}x{h}")
         print(f"y is a {type(v[1]).__name__} of", v[1].tolist())
         print()
-        for k in v[2]:
-            print(f"{k}=", v[2][k])
+        if isinstance(v[2], dict):
+            for k in v[2]:
+                print(f"{k}=", v[2][k])
+        else:  # sample ids of `compact_extra`
+            print("path=", data_loader.dataset.get_paths(v[2]))
 
     except StopIteration:
         print('StopIteration')
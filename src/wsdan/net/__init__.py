@@ -5,21 +5,55 @@ from torch.nn import functional
 import torchvision
 from torchvision import models
 
-import numpy as np
 import logging
 
 EPSILON = 1e-12
 
 
+class SignSqrtNormalize(torch.autograd.Function):
+    """
+    sign-sqrt followed by the l2 normalization along the last dimension, as one epilogue
+
+    The forward works in place on a single buffer instead of allocating a (B, M * C) tensor per step, and the backward
+    is the closed form of the autograd one: d/dx sign(x) * sqrt(|x| + eps) = 0.5 / sqrt(|x| + eps), 0 at x = 0.
+    """
+
+    @staticmethod
+    def forward(ctx, x):
+        y = x.abs().add_(EPSILON).sqrt_().mul_(x.sign())
+        norm = torch.linalg.vector_norm(y, dim=-1, keepdim=True).clamp_min_(EPSILON)  # as `functional.normalize`
+        y.div_(norm)
+        ctx.save_for_backward(y, norm)
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        z, norm = ctx.saved_tensors
+        # through the normalization, then the sign-sqrt, whose derivative is 0.5 / |y| with y = z * norm
+        grad = (grad_output - z * (grad_output * z).sum(dim=-1, keepdim=True)) / norm
+        return torch.where(z != 0, grad * 0.5 / (z.abs() * norm), torch.zeros_like(grad))
+
+
 # Bilinear Attention Pooling
 class BAP(nn.Module):
-    def __init__(self, pool='GAP'):
+    def __init__(self, pool='GAP', chunk_size=None):
+        """
+        :param pool: 'GAP' or 'GMP'
+        :param chunk_size: (optional) number of attention maps pooled at once, to cap the peak memory; if None, all of
+                           them for 'GAP', and for 'GMP' as many as keep its (B, chunk, C, H * W) product under 1M
+                           elements, which stays in cache and is as fast as pooling the maps one by one on cpu
+        """
         super(BAP, self).__init__()
         assert pool in ['GAP', 'GMP']
-        if pool == 'GAP':
-            self.pool = None
-        else:
-            self.pool = nn.AdaptiveMaxPool2d(1)
+        self.pool = pool
+        self.chunk_size = chunk_size
+
+    def get_chunk_size(self, B, M, C, HW):
+        if self.chunk_size is not None:
+            return self.chunk_size
+        if self.pool == 'GAP':
+            return M
+        return max(1, (1 << 20) // (B * C * HW))
 
     def forward(self, features, attentions):
         B, C, H, W = features.size()
@@ -29,22 +63,24 @@ class BAP(nn.Module):
         if AH != H or AW != W:
             attentions = functional.interpolate(attentions, size=(H, W), mode='bilinear')
 
-        # feature_matrix: (B, M, C) -> (B, M * C)
-        if self.pool is None:
-            feature_matrix = (torch.einsum('imjk,injk->imn', (attentions, features)) / float(H * W)).view(B, -1)
-        else:
-            feature_matrix = []
-            for i in range(M):
-                AiF = self.pool(features * attentions[:, i:i + 1, ...]).view(B, -1)
-                feature_matrix.append(AiF)
-            feature_matrix = torch.cat(feature_matrix, dim=1)
+        features = features.reshape(B, C, H * W)
+        attentions = attentions.reshape(B, M, H * W)
 
-        # sign-sqrt
-        feature_matrix = torch.sign(feature_matrix) * torch.sqrt(torch.abs(feature_matrix) + EPSILON)
+        # feature_matrix: (B, M, C), by chunks of attention maps
+        chunk_size = self.get_chunk_size(B, M, C, H * W)
+        chunks = []
+        for m in range(0, M, chunk_size):
+            A = attentions[:, m:m + chunk_size]
+            if self.pool == 'GAP':
+                chunks.append(torch.bmm(A, features.transpose(1, 2)) / float(H * W))
+            else:
+                # max() rather than amax(), whose backward spreads the gradient over the ties at a higher cost
+                chunks.append((A.unsqueeze(2) * features.unsqueeze(1)).max(dim=-1).values)
+        feature_matrix = chunks[0] if len(chunks) == 1 else torch.cat(chunks, dim=1)
 
-        # l2 normalization along dimension M and C
-        feature_matrix = functional.normalize(feature_matrix, dim=-1)
-        return feature_matrix
+        # sign-sqrt and l2 normalization along dimension M and C, (B, M, C) -> (B, M * C), in float32 even under
+        # bfloat16 autocast, the sqrt being steep near 0
+        return SignSqrtNormalize.apply(feature_matrix.reshape(B, M * C).float())
 
 
 """Create BasicConv2d Layer and also perform a batch normalization operation."""
@@ -62,13 +98,37 @@ class BasicConv2d(nn.Module):
         return functional.relu(x, inplace=True)
 
 
+def widen_first_conv(features, in_channels):
+    """
+    Give the first Conv2d of `features` `in_channels` input channels, the extra ones starting from the weights of
+    channel 0, as `Resnet_multichannel.increase_channels` does
+    """
+    name, conv = next((name, m) for name, m in features.named_modules() if isinstance(m, nn.Conv2d))
+    if conv.in_channels == in_channels:
+        return
+
+    new_conv = nn.Conv2d(in_channels, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride,
+                         padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                         bias=conv.bias is not None)
+    with torch.no_grad():
+        new_conv.weight[:, :conv.in_channels] = conv.weight
+        new_conv.weight[:, conv.in_channels:] = conv.weight[:, :1]
+        if conv.bias is not None:
+            new_conv.bias.copy_(conv.bias)
+
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(features.get_submodule(parent_name), child_name, new_conv)
+
+
 # WS-DAN: Weakly Supervised Data Augmentation Network for FGVC
 class WSDAN(nn.Module):
-    def __init__(self, num_classes, M=32, model='inception', pretrained=False):
+    def __init__(self, num_classes, M=32, model='inception', pretrained=False, in_channels=3, generator=None):
         super(WSDAN, self).__init__()
         self.num_classes = num_classes
         self.M = M
         self.model = model
+        self.generator = generator  # (optional) torch.Generator on the compute device, for reproducible attention sampling
+        self.channels_last = False
 
         # Network Initialization
         if 'densenet121' in model:
@@ -103,6 +163,10 @@ class WSDAN(nn.Module):
         else:
             raise ValueError('Unsupported model: %s' % model)
 
+        # e.g. 4 for RGB + doppler mask, see `MaskStore`
+        self.in_channels = in_channels
+        widen_first_conv(self.features, in_channels)
+
         # Attention Maps
         self.attentions = BasicConv2d(self.num_features, self.M, kernel_size=1)
 
@@ -114,8 +178,15 @@ class WSDAN(nn.Module):
 
         logging.info('WSDAN: using {} as feature extractor, num_classes: {}, num_attentions: {}'.format(model, self.num_classes, self.M))
 
+    def to_channels_last(self):
+        """Run in channels-last memory format, the inputs included, e.g. along with CPU bfloat16 autocast"""
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
         batch_size = x.size(0)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
         # Feature Maps, Attention Maps and Feature Matrix
         feature_maps = self.features(x)
@@ -131,15 +202,12 @@ class WSDAN(nn.Module):
 
         # Generate Attention Map
         if self.training:
-            # Randomly choose one of attention maps Ak
-            attention_map = []
-            for i in range(batch_size):
-                attention_weights = torch.sqrt(attention_maps[i].sum(dim=(1, 2)).detach() + EPSILON)
-                attention_weights = functional.normalize(attention_weights, p=1, dim=0)
-                # Randomly picked out two.
-                k_index = np.random.choice(self.M, 2, p=attention_weights.cpu().numpy())
-                attention_map.append(attention_maps[i, k_index, ...])
-            attention_map = torch.stack(attention_map)  # (B, 2, H, W) - one for cropping, the other for dropping
+            # Randomly choose one of attention maps Ak, for the whole batch on the device, i.e. no host sync
+            attention_weights = torch.sqrt(attention_maps.detach().float().sum(dim=(2, 3)) + EPSILON)  # (B, M)
+            # Randomly picked out two, with replacement as `np.random.choice` was
+            k_index = torch.multinomial(attention_weights, 2, replacement=True, generator=self.generator)  # (B, 2)
+            attention_map = attention_maps[torch.arange(batch_size, device=k_index.device).view(-1, 1), k_index]
+            # (B, 2, H, W) - one for cropping, the other for dropping
         else:
             # Object Localization Am = mean(Ak)
             # In the testing case, it will avrage all the attention(combine) into single attention map
@@ -5,9 +5,9 @@ from torchvision import transforms
 ToPILImage = transforms.ToPILImage()
 
 import numpy as np
-import random
 import os
-from .doppler import resolve_hw_slices, get_path_doppler, get_bbox_doppler, bbox_to_hw_slices
+from .doppler import resolve_crop_boxes, get_bboxes_doppler, bbox_to_masks
+from .debug_writer import get_debug_writer
 
 import logging
 logger = logging.getLogger('@@')
@@ -25,20 +25,26 @@ def generate_heatmap(attention_maps):
 def get_raw_image(batch_image):
     MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
     STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
-    return batch_image * STD + MEAN
+    return batch_image[:, :3] * STD + MEAN  # RGB only, e.g. without the mask of a 4-channel batch
 
-def dump_heatmap(savepath, prefix, raw_image, atten_map, imgH, imgW, batch_index):
-    rimg = ToPILImage(raw_image[batch_index])
-    rimg.save(os.path.join(savepath, f'{prefix}_raw.png'))
+def _save_pil_images(images_paths):
+    for image, path in images_paths:
+        ToPILImage(image).save(path)
 
+def dump_heatmap(savepath, prefix, raw_image, atten_map, imgH, imgW, batch_index, block=False):
+    """
+    Save the raw image and its attention heatmap of `batch_index`, on a thread of the debug writer
+    :param block: if True, wait for room in the writer queue rather than dropping the dump
+    """
     _attention_maps = functional.interpolate(
         atten_map, size=(imgH, imgW), mode='bilinear')
     _attention_maps = _attention_maps.cpu() / _attention_maps.max().item()
     heat_attention_map = generate_heatmap(_attention_maps)
 
-    heat_attention_image = (raw_image * 0.3) + (heat_attention_map.cpu() * 0.7)
-    himg = ToPILImage(heat_attention_image[batch_index])
-    himg.save(os.path.join(savepath, f'{prefix}_heat_atten.png'))
+    heat_attention_image = (raw_image[batch_index] * 0.3) + (heat_attention_map[0] * 0.7)
+    get_debug_writer().submit(_save_pil_images, [
+        (raw_image[batch_index], os.path.join(savepath, f'{prefix}_raw.png')),
+        (heat_attention_image, os.path.join(savepath, f'{prefix}_heat_atten.png'))], block=block)
 
 def NormalizeData(data):
     return (data - np.min(data)) / (np.max(data) - np.min(data))
@@ -48,75 +54,116 @@ def img_gpu_to_cpu(img):
     img_full = NormalizeData(img_full) * 255
     return img_full
 
+def imwrite_normalized(path, img):
+    import cv2
+    cv2.imwrite(path, img_gpu_to_cpu(img))
+
+def get_thresholds(attention_map, theta):
+    """
+    :param attention_map: (B, 1, h, w) attention maps
+    :param theta: float, tuple of (low, high) to draw one theta per sample from, or (B,) tensor
+    :return: (B, 1, 1, 1) thresholds, i.e. theta times the max of each attention map
+    """
+    batches = attention_map.size(0)
+    if isinstance(theta, tuple):
+        theta = torch.empty(batches, device=attention_map.device).uniform_(*theta)
+    elif not torch.is_tensor(theta):
+        theta = torch.full((batches,), theta, device=attention_map.device)
+    return theta.to(attention_map).view(-1, 1, 1, 1) * attention_map.amax(dim=(1, 2, 3), keepdim=True)
+
+def get_crop_boxes(attention_map, size, theta, padding_ratio):
+    """
+    Batched attention crop boxes: the extent of the upsampled attention map at or above its threshold, padded
+
+    The extent is read off the row and column maxima, so there is neither `torch.nonzero` nor a host sync.
+    :param size: tuple of (H, W) of the images
+    :param theta: see `get_thresholds`
+    :return: (B, 4) float tensor of the boxes (x1, y1, x2, y2) in whole pixels, on the device of `attention_map`
+    """
+    imgH, imgW = size
+    crop_mask = functional.interpolate(attention_map, size=size, mode='bilinear') >= \
+        get_thresholds(attention_map, theta)
+    rows = crop_mask.any(dim=3)[:, 0]  # (B, H)
+    cols = crop_mask.any(dim=2)[:, 0]  # (B, W)
+
+    # first and last True index, by argmax over the bools
+    height_min = rows.int().argmax(dim=1)
+    height_max = imgH - 1 - rows.flip(1).int().argmax(dim=1)
+    width_min = cols.int().argmax(dim=1)
+    width_max = imgW - 1 - cols.flip(1).int().argmax(dim=1)
+
+    pad_h, pad_w = padding_ratio * imgH, padding_ratio * imgW
+    return torch.stack([
+        (width_min - pad_w).clamp(min=0).floor(),
+        (height_min - pad_h).clamp(min=0).floor(),
+        (width_max + pad_w).floor().clamp(max=imgW),
+        (height_max + pad_h).floor().clamp(max=imgH)], dim=1)
+
+def crop_resize(images, boxes, size):
+    """
+    Crop each sample to its box and resize it to `size`, for the whole batch in one `grid_sample` call
+
+    It samples where `interpolate(images[idx:idx + 1, :, sh, sw], size, mode='bilinear')` does for the slices of
+    `bbox_to_hw_slices(box)`, i.e. at the pixel centers, clamped to the box.
+    :param boxes: (B, 4) float tensor of the boxes (x1, y1, x2, y2)
+    """
+    _, _, imgH, imgW = images.size()
+    outH, outW = size
+    boxes = boxes.to(images).trunc()  # as the int() of `bbox_to_hw_slices`
+    x1, y1, x2, y2 = [v.view(-1, 1) for v in boxes.unbind(dim=1)]
+
+    def source(start, length, out_length, in_length):
+        # pixel coordinates as in `interpolate(align_corners=False)`, normalized for `grid_sample(align_corners=False)`
+        i = torch.arange(out_length, device=images.device, dtype=images.dtype).view(1, -1)
+        p = ((i + 0.5) * (length / out_length) - 0.5).clamp(min=0.)
+        p = start + torch.minimum(p, length - 1)
+        return (2. * p + 1.) / in_length - 1.
+
+    gy = source(y1, y2 - y1, outH, imgH)  # (B, outH)
+    gx = source(x1, x2 - x1, outW, imgW)  # (B, outW)
+    grid = torch.stack(torch.broadcast_tensors(gx[:, None, :], gy[:, :, None]), dim=-1)  # (B, outH, outW, 2)
+    return functional.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
 def batch_augment(images, paths, attention_map, savepath=None,
-                  use_doppler=False, config_doppler=None,
+                  use_doppler=False, config_doppler=None, bboxes_doppler=None,
                   mode='crop', theta=0.5, padding_ratio=0.1):
+    """
+    :param bboxes_doppler: (optional) (B, 4) doppler bboxes already scaled to the image size, NaN where not
+                           detected, e.g. resolved by DopplerThyroidDataset; if None, they're looked up by `paths`
+    """
     logger.debug(f'images.size(): {images.size()}')
-    raw_image = get_raw_image(images.cpu())  # @@
+    raw_image = get_raw_image(images.cpu()) if savepath is not None else None  # @@ only for the debug dumps
     batches, _, imgH, imgW = images.size()
 
     if mode == 'crop':
-        crop_images = []
-        for idx in range(batches):
-            atten_map = attention_map[idx:idx + 1]
-            if savepath is not None:  # @@ debug
-                dump_heatmap(savepath, f'debug_crop_idx_{idx}', raw_image, atten_map, imgH, imgW, idx)
-            if isinstance(theta, tuple):
-                theta_c = random.uniform(*theta) * atten_map.max()
-            else:
-                theta_c = theta * atten_map.max()
-
-            crop_mask = functional.interpolate(atten_map, size=(imgH, imgW), mode='bilinear') >= theta_c
-            nonzero_indices = torch.nonzero(crop_mask[0, 0, ...])
-            height_min = max(int(nonzero_indices[:, 0].min().item() - padding_ratio * imgH), 0)
-            height_max = min(int(nonzero_indices[:, 0].max().item() + padding_ratio * imgH), imgH)
-            width_min = max(int(nonzero_indices[:, 1].min().item() - padding_ratio * imgW), 0)
-            width_max = min(int(nonzero_indices[:, 1].max().item() + padding_ratio * imgW), imgW)
-
-            #-------- @@
-            logger.debug(f'[idx={idx}] crop: ({width_min}, {height_min}), ({width_max}, {height_max})')
-
-            disable_doppler_crop = config_doppler.get('disable_doppler_crop', False)\
-                if config_doppler is not None else False
-            if use_doppler and not disable_doppler_crop:
-                #logger.debug('doppler_crop is ON')
-
-                bbox_crop = np.array([
-                    width_min, height_min,
-                    width_max, height_max], dtype=np.float32)
-                train_img_copy = np.array(
-                    img_gpu_to_cpu(images[idx])).astype(np.uint8).copy()
-                train_img_path = paths[idx]
-
-                sh, sw = resolve_hw_slices(
-                    bbox_crop, train_img_copy, train_img_path, idx, (imgH, imgW), savepath, config_doppler)
-            else:
-                #logger.debug('doppler_crop is OFF')
-                sh, sw = slice(height_min, height_max), slice(width_min, width_max)
-            #-------- @@
-
-            crop_images.append(functional.interpolate(
-                #images[idx:idx + 1, :, height_min:height_max, width_min:width_max],
-                images[idx:idx + 1, :, sh, sw],  # @@
-                size=(imgH, imgW), mode='bilinear'))
-
-        crop_images = torch.cat(crop_images, dim=0)
+        if savepath is not None:  # @@ debug
+            for idx in get_debug_writer().sample_indices(batches):
+                dump_heatmap(savepath, f'debug_crop_idx_{idx}', raw_image, attention_map[idx:idx + 1], imgH, imgW, idx)
+
+        bbox_crop = get_crop_boxes(attention_map, (imgH, imgW), theta, padding_ratio)
+        logger.debug(f'bbox_crop: {bbox_crop}')
+
+        disable_doppler_crop = config_doppler.get('disable_doppler_crop', False)\
+            if config_doppler is not None else False
+        if use_doppler and not disable_doppler_crop:
+            #logger.debug('doppler_crop is ON')
+            bbox_crop = resolve_crop_boxes(
+                bbox_crop, paths, (imgH, imgW), config_doppler,
+                bbox_doppler=bboxes_doppler, savepath=savepath,
+                get_debug_image=lambda idx: np.array(img_gpu_to_cpu(images[idx])).astype(np.uint8).copy())
+
+        crop_images = crop_resize(images, bbox_crop, (imgH, imgW))
         logger.debug(f"crop_images.shape: {crop_images.shape}")
         return crop_images
 
     elif mode == 'drop':
-        drop_masks = []
-        for idx in range(batches):
-            atten_map = attention_map[idx:idx + 1]
-            if savepath is not None:  # @@ debug
-                dump_heatmap(savepath, f'debug_drop_idx_{idx}', raw_image, atten_map, imgH, imgW, idx)
-
-            if isinstance(theta, tuple):
-                theta_d = random.uniform(*theta) * atten_map.max()
-            else:
-                theta_d = theta * atten_map.max()
-            drop_masks.append(functional.interpolate(
-                atten_map, size=(imgH, imgW), mode='bilinear') < theta_d)
+        if savepath is not None:  # @@ debug
+            for idx in get_debug_writer().sample_indices(batches):
+                dump_heatmap(savepath, f'debug_drop_idx_{idx}', raw_image, attention_map[idx:idx + 1], imgH, imgW, idx)
+
+        # (B, 1, H, W), upsampled and thresholded for the whole batch at once
+        drop_masks = functional.interpolate(attention_map, size=(imgH, imgW), mode='bilinear') < \
+            get_thresholds(attention_map, theta)
 
         disable_doppler_drop = config_doppler.get('disable_doppler_drop', False)\
             if config_doppler is not None else False
@@ -125,25 +172,22 @@ def batch_augment(images, paths, attention_map, savepath=None,
         if use_doppler and not disable_doppler_drop:
             #logger.debug('doppler_drop is ON')
 
-            drop_masks = torch.cat(drop_masks, dim=0).float()
+            drop_masks = drop_masks.float()
 
+            # the samples without a detected doppler bbox keep their attention drop mask as is
             img_sz = (imgH, imgW)
-            for idx in range(drop_masks.shape[0]):
-                bbox_doppler = get_bbox_doppler(get_path_doppler(paths[idx]), img_sz)
-                if bbox_doppler is not None:
-                    doppler_mask = torch.full(img_sz, 0.)
-                    sh, sw = bbox_to_hw_slices(bbox_doppler)
-                    for ridx in range(sh.start, sh.stop):
-                        doppler_mask[ridx][sw] = 1.
-
-                    #logger.debug(f"!! BEF drop_masks[idx]: {drop_masks[idx]}")
-                    drop_masks[idx][0] = doppler_mask * drop_masks[idx][0].cpu()
-                    #logger.debug(f"!! AFT drop_masks[idx]: {drop_masks[idx]}")
+            if bboxes_doppler is None:
+                bboxes_doppler = get_bboxes_doppler(paths, img_sz)
+            bboxes_doppler = bboxes_doppler.to(drop_masks.device)
+            found = ~bboxes_doppler.isnan().any(dim=1)
+
+            doppler_masks = bbox_to_masks(bboxes_doppler.nan_to_num(0.), img_sz)
+            found = found.view(-1, 1, 1, 1)
+            drop_masks = torch.where(found, doppler_masks * drop_masks, drop_masks)
 
             drop_images = images * drop_masks
         else:  #==== orig
             #logger.debug('doppler_drop is OFF')
-            drop_masks = torch.cat(drop_masks, dim=0)
             drop_images = images * drop_masks.float()
         #====
 
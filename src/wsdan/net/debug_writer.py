@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+
+import logging
+logger = logging.getLogger('@@')
+
+
+class DebugWriter:
+    """
+    Background writer of the debug artifacts(images), so that encoding and writing them doesn't stall training
+
+    Jobs go through a bounded queue to a pool of threads, cv2/PIL encoders releasing the GIL. When the queue is full,
+    a job is dropped rather than blocking the caller, unless submitted with `block=True`. The sampling policy, every
+    Nth batch and K samples per batch, is up to the callers through `wants` and `sample_indices`.
+    """
+
+    def __init__(self, workers=2, max_queue=64, every=1, samples=None):
+        """
+        :param workers: number of writing threads
+        :param max_queue: number of pending jobs beyond which the new ones are dropped
+        :param every: dump every `every`-th batch
+        :param samples: number of samples dumped per batch, all if None
+        """
+        self.every = every
+        self.samples = samples
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(max_queue)
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.failed += 1
+                logger.debug(f'DebugWriter: {fn.__name__} failed: {e}')
+            finally:
+                self._queue.task_done()
+
+    def wants(self, batch_idx):
+        return batch_idx % self.every == 0
+
+    def sample_indices(self, batches):
+        return range(batches if self.samples is None else min(self.samples, batches))
+
+    def submit(self, fn, *args, block=False):
+        """
+        Run `fn(*args)` on a writing thread; the args should be host-side(numpy/cpu) data
+        :return: False if dropped, the queue being full
+        """
+        try:
+            self._queue.put((fn, args), block=block)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def imwrite(self, path, img, block=False):
+        """`cv2.imwrite` on a writing thread"""
+        import cv2
+        return self.submit(cv2.imwrite, path, img, block=block)
+
+    def flush(self):
+        """Wait for the pending jobs to be written"""
+        self._queue.join()
+
+
+_debug_writer = None
+
+def get_debug_writer():
+    """
+    The debug writer of this process, dumping every `WSDAN_DEBUG_EVERY`-th batch(default 1) and
+    `WSDAN_DEBUG_SAMPLES` samples per batch(default all)
+    """
+    global _debug_writer
+    if _debug_writer is None:
+        samples = os.environ.get('WSDAN_DEBUG_SAMPLES')
+        _debug_writer = DebugWriter(every=int(os.environ.get('WSDAN_DEBUG_EVERY', 1)),
+                                    samples=int(samples) if samples else None)
+    return _debug_writer
+
+def is_debug_enabled():
+    """True if `WSDAN_DEBUG_EVERY` is set, i.e. the training dumps the debug artifacts"""
+    return os.environ.get('WSDAN_DEBUG_EVERY') is not None
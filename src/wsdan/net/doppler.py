@@ -1,14 +1,23 @@
 import os
-import cv2
 import numpy as np
-import pandas as pd
+import torch
 import hashlib
+import csv
+import functools
+import glob
+import json
+import re
+
+from .doppler_index import get_doppler_index
+# `cv2` is imported by the functions using it, so that importing the training loop doesn't load OpenCV
 
 import logging
 logger = logging.getLogger('@@')
 
 
 def detect_doppler(img):
+    import cv2
+
     if len(img.shape) < 3:
         #print('gray_scale')
         img = cv2.cvtColor(img,cv2.COLOR_GRAY2RGB)
@@ -68,6 +77,102 @@ def detect_doppler(img):
     return [min_x, min_y, max_x, max_y]
 
 
+def _is_axis_aligned(approx):
+    """The four-edge angle test of `detect_doppler`, for all edges at once"""
+    xy = approx.reshape(4, 2)
+    d = np.roll(xy, -1, axis=0) - xy
+    angle = np.absolute(np.arctan2(d[:, 1], d[:, 0])) * 180 / np.pi
+    angle = np.where((angle > 45) & (angle < 135), angle - 90, angle)
+    angle = np.where(angle >= 135, angle - 180, angle)
+    return not (angle > 3).any()
+
+def _find_doppler_rect(threshold, min_area=0., keep_out=None, largest_only=False, min_fill=0.):
+    """
+    The largest contour of `threshold` approximated by an axis-aligned quadrilateral, as picked by `detect_doppler`
+    Contours are visited by decreasing area, so the polygon work stops at the first one passing.
+    :param keep_out: (optional) tuple of (left, top, right, bottom) flags, rejecting contours touching those borders
+    :param largest_only: if True, None unless the largest contour passes
+    :param min_fill: contours whose area is less than this fraction of their quadrilateral are rejected, e.g. a box
+                     border broken open
+    """
+    import cv2
+
+    contours, _ = cv2.findContours(threshold, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    areas = [cv2.contourArea(cnt) for cnt in contours]
+    height, width = threshold.shape[:2]
+
+    for idx in sorted(range(len(contours)), key=lambda i: -areas[i]):  # stable, the first of equal areas wins
+        if areas[idx] <= min_area:
+            break
+        cnt = contours[idx]
+        cut = False
+        if keep_out is not None:
+            x, y, w, h = cv2.boundingRect(cnt)
+            cut = (keep_out[0] and x == 0) or (keep_out[1] and y == 0) or \
+                (keep_out[2] and x + w == width) or (keep_out[3] and y + h == height)
+        if not cut:
+            hull = cv2.convexHull(cnt, returnPoints=True)
+            approx = cv2.approxPolyDP(hull, 0.01 * cv2.arcLength(cnt, True), True)
+            if len(approx) == 4 and _is_axis_aligned(approx) and \
+                    areas[idx] >= min_fill * cv2.contourArea(approx):
+                return approx
+        if largest_only:
+            break
+    return None
+
+def _rect_to_bbox(approx, offset=(0, 0)):
+    xy = approx.reshape(4, 2)
+    return [float(xy[:, 0].min() + offset[0]), float(xy[:, 1].min() + offset[1]),
+            float(xy[:, 0].max() + offset[0]), float(xy[:, 1].max() + offset[1])]
+
+def detect_doppler_fast(img, scale=1., margin=8, min_area=0.):
+    """
+    Same bbox as `detect_doppler`, visiting the contours by decreasing area and stopping at the first valid one
+
+    With `scale` < 1, the coarse bbox is only a hint: it is kept when the largest contour is a closed rect at both
+    scales and the refined rect contains the coarse one, else the detection runs again at full scale. This matched
+    `detect_doppler` on the `doppler_synth` frames, but unlike `scale=1` it isn't guaranteed for any image.
+    :param img: BGR or grayscale image
+    :param scale: if < 1, detect on the image downscaled by `scale` first, then refine within that bbox at full scale
+    :param margin: the refining margin in full-scale pixels, around the upscaled coarse bbox
+    :param min_area: contours of this area or less are never considered
+    :return: [min_x, min_y, max_x, max_y] or None
+    """
+    import cv2
+
+    green_image = img if len(img.shape) < 3 else img[:, :, 1]
+    green_image = np.ascontiguousarray(green_image, dtype=np.uint8)
+
+    if scale < 1.:
+        small = cv2.resize(green_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        _, threshold = cv2.threshold(small, 200, 255, cv2.THRESH_BINARY)
+        # the coarse contour is trusted only if it's the largest and closed, as the ranking of a larger contour
+        # failing at this scale, or of a box border broken open, may change at the full scale
+        approx = _find_doppler_rect(threshold, min_area * scale * scale, largest_only=True, min_fill=.5)
+        if approx is not None:
+            height, width = green_image.shape
+            x1, y1, x2, y2 = _rect_to_bbox(approx)
+            left, top = max(int(x1 / scale) - margin, 0), max(int(y1 / scale) - margin, 0)
+            right, bottom = min(int(x2 / scale) + margin + 1, width), min(int(y2 / scale) + margin + 1, height)
+            _, threshold = cv2.threshold(green_image[top:bottom, left:right], 200, 255, cv2.THRESH_BINARY)
+            # the largest contour of the window must pass, and not be cut by the window unless by the image border
+            approx = _find_doppler_rect(threshold, min_area, largest_only=True,
+                                        keep_out=(left > 0, top > 0, right < width, bottom < height))
+            if approx is not None:
+                bbox = _rect_to_bbox(approx, offset=(left, top))
+                # the refined rect must contain the coarse one within a coarse pixel, else e.g. the inner edge of
+                # the box border or a smaller rect was picked
+                tol = 1. / scale
+                if bbox[0] <= x1 / scale + tol and bbox[1] <= y1 / scale + tol and \
+                        bbox[2] >= x2 / scale - tol and bbox[3] >= y2 / scale - tol:
+                    return bbox
+        # fall back to the full scale
+
+    _, threshold = cv2.threshold(green_image, 200, 255, cv2.THRESH_BINARY)
+    approx = _find_doppler_rect(threshold, min_area)
+    return _rect_to_bbox(approx) if approx is not None else None
+
+
 def get_iou(truth, pred):
     # coordinates of the area of intersection.
     ix1 = np.maximum(truth[0], pred[0])
@@ -112,7 +217,15 @@ def get_iou(truth, pred):
 
 #
 
+def load_markers_label(path_markers_label):
+    """
+    :return: array of the whitespace-separated marker rows, columns 1 and 2 being the normalized x and y
+    """
+    return np.loadtxt(path_markers_label, dtype=np.float64, ndmin=2)
+
 def doppler_comp(path_doppler, path_markers, path_markers_label):
+    import cv2
+
     img_doppler = cv2.imread(path_doppler)
     width = int(img_doppler.shape[1])
     height = int(img_doppler.shape[0])
@@ -131,15 +244,7 @@ def doppler_comp(path_doppler, path_markers, path_markers_label):
 
     #
 
-    label_markers = pd.read_csv(path_markers_label, header=None, index_col=False).to_numpy()
-    temp_row = []
-    for row in label_markers:
-        temp_col = []
-        for col in row:
-            for item in col.split():
-                temp_col.append(float(item))
-        temp_row.append(np.array(temp_col))
-    temp = np.array(temp_row)
+    temp = load_markers_label(path_markers_label)
 
     x1_markers = np.min(temp[:,1])
     x2_markers = np.max(temp[:,1])
@@ -1032,34 +1137,102 @@ def bbox_to_hw_slices(bbox):
         slice(int(bbox[1]), int(bbox[3])),  # i.e. height_min:height_max
         slice(int(bbox[0]), int(bbox[2])))  # i.e. width_min:width_max
 
+def bbox_to_masks(boxes, size):
+    """
+    Batched box masks, covering the same pixels as slicing with `bbox_to_hw_slices`
+    :param boxes: (B, 4) float tensor of boxes (x1, y1, x2, y2)
+    :param size: tuple of (H, W) of the masks
+    :return: (B, 1, H, W) float tensor of ones inside the boxes, on the device of `boxes`
+    """
+    boxes = boxes.trunc()  # as `int()` does
+    ys = torch.arange(size[0], device=boxes.device, dtype=boxes.dtype).view(1, -1, 1)
+    xs = torch.arange(size[1], device=boxes.device, dtype=boxes.dtype).view(1, 1, -1)
+    x1, y1, x2, y2 = [boxes[:, i].view(-1, 1, 1) for i in range(4)]
+    masks = (ys >= y1) & (ys < y2) & (xs >= x1) & (xs < x2)
+    return masks.unsqueeze(1).float()
+
 def bbox_draw(img, bbox, color=(255, 0, 0), thickness=1):
+    import cv2
+
     return cv2.rectangle(img,
         (int(bbox[0]), int(bbox[1])),
         (int(bbox[2]), int(bbox[3])), color, thickness)
 
 
+DOPPLER_PAIRS_MANIFESTS = ('doppler_pairs.csv', 'doppler_pairs.json')  # under the dataset root
+
+# e.g. 'malignant_nodule3_0031-0060_c0032_1_p0005.png' -> ('malignant_nodule3_0031-0060', 'c0032', 'p0005')
+_PAIR_TOKENS = re.compile(r'^(?P<prefix>.+)_(?P<case>c\d+)_\d+_(?P<page>p\d+)\.png$')
+
+def load_doppler_pairs(path, root):
+    """
+    Load a B-mode to doppler mapping, either a CSV of `<B-mode path>,<doppler path>` rows or a JSON object,
+    the paths being relative to `root`
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            pairs = json.load(f).items()
+    else:
+        with open(path, newline='') as f:
+            pairs = [row[:2] for row in csv.reader(f) if len(row) >= 2 and not row[0].startswith('#')]
+    return {os.path.join(root, bmode): os.path.join(root, doppler) for bmode, doppler in pairs}
+
+def discover_doppler_pairs(root):
+    """
+    Pair the B-mode images of `root` with its doppler images, by the same file name or else by the
+    (prefix, cXXXX, pXXXX) tokens of the file name when that picks a single doppler image
+    """
+    by_name, by_tokens = {}, {}
+    for path in glob.glob(f'{root}/Doppler_Train_Crop/**/*.png', recursive=True):
+        name = os.path.basename(path)
+        by_name.setdefault(name, []).append(path)
+        m = _PAIR_TOKENS.match(name)
+        if m:
+            by_tokens.setdefault(m.group('prefix', 'case', 'page'), []).append(path)
+
+    pairs = {}
+    for path in glob.glob(f'{root}/Markers_Train_Remove_Markers/**/*.png', recursive=True):
+        name = os.path.basename(path)
+        candidates = by_name.get(name)
+        if candidates is None:
+            m = _PAIR_TOKENS.match(name)
+            candidates = by_tokens.get(m.group('prefix', 'case', 'page')) if m else None
+        if candidates is not None and len(candidates) == 1:
+            pairs[path] = candidates[0]
+    return pairs
+
+@functools.lru_cache(maxsize=None)
+def get_doppler_pairs(root):
+    """
+    The B-mode to doppler mapping of a dataset root, built once per root: the pairs discovered from the file
+    names, overridden by `get_to_doppler(root)`, overridden by the manifest in `root` if any
+    """
+    to_doppler = discover_doppler_pairs(root)
+    to_doppler.update(get_to_doppler(root))
+    for fname in DOPPLER_PAIRS_MANIFESTS:
+        path = os.path.join(root, fname)
+        if os.path.exists(path):
+            to_doppler.update(load_doppler_pairs(path, root))
+    return to_doppler
+
 def get_path_doppler(train_img_path):
     #print('@@ train_img_path:', train_img_path)
     dataset_doppler_root = train_img_path.split('/')[0]
-    to_doppler = get_to_doppler(dataset_doppler_root)
-    path_doppler = to_doppler[train_img_path] if train_img_path in to_doppler else None
+    path_doppler = get_doppler_pairs(dataset_doppler_root).get(train_img_path)
     #print('@@ path_doppler:', path_doppler)
 
     return path_doppler
 
 def get_bbox_doppler(path_doppler, size):
-    # get doppler bbox (scaled)
-    raw = cv2.imread(path_doppler)
-    if raw is None:
-        raise ValueError(f'invalid `raw` for: {path_doppler}')
-    bbox_raw = detect_doppler(raw)
+    # get doppler bbox (scaled), each doppler image is read and detected at most once via the doppler index
+    bbox_raw, (raw_h, raw_w) = get_doppler_index().lookup(path_doppler)
     if bbox_raw is None:
         logger.debug(f'detect_doppler() failed for: {path_doppler}; using `bbox_crop` instead')
         return None
 
     bbox = np.array([
-        bbox_raw[0] * size[0] / raw.shape[1], bbox_raw[1] * size[1] / raw.shape[0],
-        bbox_raw[2] * size[0] / raw.shape[1], bbox_raw[3] * size[1] / raw.shape[0]],
+        bbox_raw[0] * size[0] / raw_w, bbox_raw[1] * size[1] / raw_h,
+        bbox_raw[2] * size[0] / raw_w, bbox_raw[3] * size[1] / raw_h],
         dtype=np.float32)
 
     if bbox[2] - bbox[0] < 1. or bbox[3] - bbox[1] < 1.:
@@ -1068,45 +1241,95 @@ def get_bbox_doppler(path_doppler, size):
 
     return bbox
 
-def resolve_hw_slices(bbox_crop, train_img_copy, train_img_path, idx, size, savepath, config):
-
-    path_doppler = get_path_doppler(train_img_path)
-    if 1 and path_doppler is None:  # strict check
-        raise ValueError(f'`path_doppler` not found for: {train_img_path}')
-
-    if path_doppler:
+def get_iou_batch(truth, pred):
+    """
+    Batched `get_iou` of (B, 4) tensors
+    :return: tuple of (iou, intersection over the `pred` area), each of shape (B,)
+    """
+    ix1 = torch.maximum(truth[:, 0], pred[:, 0])
+    iy1 = torch.maximum(truth[:, 1], pred[:, 1])
+    ix2 = torch.minimum(truth[:, 2], pred[:, 2])
+    iy2 = torch.minimum(truth[:, 3], pred[:, 3])
+
+    area_of_intersection = (iy2 - iy1 + 1).clamp(min=0.) * (ix2 - ix1 + 1).clamp(min=0.)
+    area_mark = (pred[:, 2] - pred[:, 0]) * (pred[:, 3] - pred[:, 1])
+    gt_area = (truth[:, 3] - truth[:, 1] + 1) * (truth[:, 2] - truth[:, 0] + 1)
+    pd_area = (pred[:, 3] - pred[:, 1] + 1) * (pred[:, 2] - pred[:, 0] + 1)
+    area_of_union = gt_area + pd_area - area_of_intersection
+
+    return area_of_intersection / area_of_union, area_of_intersection / area_mark
+
+def get_bboxes_doppler(paths, size):
+    """
+    :return: (B, 4) float tensor of the doppler bboxes of `paths` scaled to `size`, NaN where none was detected
+    """
+    bboxes = []
+    for train_img_path in paths:
+        path_doppler = get_path_doppler(train_img_path)
+        if 1 and path_doppler is None:  # strict check
+            raise ValueError(f'`path_doppler` not found for: {train_img_path}')
         bbox = get_bbox_doppler(path_doppler, size)
-        if bbox is None:
-            return bbox_to_hw_slices(bbox_crop)
-
-        iou, isec_in_crop = get_iou(bbox, bbox_crop)
-
-        force_doppler = config.get('thresh_force_doppler_in_crop')
-        if force_doppler is not None and force_doppler:
-            qualify = 0
-        else:
-            thresh_isec_in_crop = config['thresh_isec_in_crop']  # the key must exist
-            logger.debug(f'thresh_isec_in_crop: {thresh_isec_in_crop}')
-            qualify = 1 if iou > 1e-4 and isec_in_crop > thresh_isec_in_crop else 0
-
-        digest = hashlib.md5(path_doppler.encode('utf-8')).hexdigest()
-        debug_fname_jpg = f'debug_crop_doppler_{idx}_iou_%0.4f_isecincrop_%0.3f_qualify_%d_digest_%s.jpg' % (
-            iou, isec_in_crop, qualify, digest)
-        logger.debug(f'debug_fname_jpg: {debug_fname_jpg}')
-
-        if savepath is not None:  # debug dump
+        bboxes.append(bbox if bbox is not None else np.full(4, np.nan, dtype=np.float32))
+    return torch.from_numpy(np.stack(bboxes))
+
+def resolve_crop_boxes(bbox_crop, paths, size, config, bbox_doppler=None, savepath=None, get_debug_image=None):
+    """
+    Pick, for each sample, either its attention crop box or its doppler box, in one pass over the batch
+    :param bbox_crop: (B, 4) float tensor of the attention crop boxes (x1, y1, x2, y2), on any device
+    :param paths: the B-mode image paths of the batch
+    :param size: tuple of (H, W) of the images
+    :param config: config_doppler, i.e. 'thresh_isec_in_crop' or 'thresh_force_doppler_in_crop'
+    :param bbox_doppler: (optional) (B, 4) doppler bboxes as returned by `get_bboxes_doppler`, looked up if None
+    :param savepath: (optional) debug dump directory
+    :param get_debug_image: function of a batch index returning the uint8 HWC image, called only with `savepath`
+    :return: (B, 4) float tensor of the resolved boxes, on the device of `bbox_crop`
+    """
+    if bbox_doppler is None:
+        bbox_doppler = get_bboxes_doppler(paths, size)
+    bbox_doppler = bbox_doppler.to(bbox_crop.device)
+    found = ~bbox_doppler.isnan().any(dim=1)
+    bbox_doppler = bbox_doppler.nan_to_num(0.)
+    iou, isec_in_crop = get_iou_batch(bbox_doppler, bbox_crop)
+
+    force_doppler = config.get('thresh_force_doppler_in_crop')
+    if force_doppler is not None and force_doppler:
+        qualify = torch.zeros_like(found)
+    else:
+        thresh_isec_in_crop = config['thresh_isec_in_crop']  # the key must exist
+        logger.debug(f'thresh_isec_in_crop: {thresh_isec_in_crop}')
+        qualify = (iou > 1e-4) & (isec_in_crop > thresh_isec_in_crop)
+
+    # the crop box if no doppler bbox was detected, or if the crop already covers enough of it
+    use_crop = qualify | ~found
+    boxes = torch.where(use_crop.view(-1, 1), bbox_crop, bbox_doppler)
+
+    if savepath is not None:  # debug dump, of the sampled indices only, written by the debug writer
+        from .debug_writer import get_debug_writer
+        writer = get_debug_writer()
+        sampled = writer.sample_indices(len(paths))
+        for idx, (train_img_path, bbox, bbox_c, found_, iou_, isec_in_crop_, qualify_) in enumerate(zip(
+                paths, bbox_doppler.tolist(), bbox_crop.tolist(),
+                found.tolist(), iou.tolist(), isec_in_crop.tolist(), qualify.tolist())):
+            if not found_ or idx not in sampled:
+                continue
+            digest = hashlib.md5(get_path_doppler(train_img_path).encode('utf-8')).hexdigest()
+            debug_fname_jpg = f'debug_crop_doppler_{idx}_iou_%0.4f_isecincrop_%0.3f_qualify_%d_digest_%s.jpg' % (
+                iou_, isec_in_crop_, qualify_, digest)
+            logger.debug(f'debug_fname_jpg: {debug_fname_jpg}')
+
+            train_img_copy = get_debug_image(idx)
             bbox_draw(train_img_copy, bbox, (255, 255, 0), 1)  # blue
-            bbox_draw(train_img_copy, bbox_crop, (0, 0, 255), 1)  # red
-            cv2.imwrite(os.path.join(savepath, debug_fname_jpg), train_img_copy)
+            bbox_draw(train_img_copy, bbox_c, (0, 0, 255), 1)  # red
+            writer.imwrite(os.path.join(savepath, debug_fname_jpg), train_img_copy)
 
             # crop patch image; OK
-            sh_, sw_ = bbox_to_hw_slices(bbox_crop)
+            sh_, sw_ = bbox_to_hw_slices(bbox_c)
             img_ = train_img_copy.copy()[sh_, sw_, :]
-            cv2.imwrite(os.path.join(savepath, f'debug_crop_idx_{idx}.jpg'), img_)
+            writer.imwrite(os.path.join(savepath, f'debug_crop_idx_{idx}.jpg'), img_)
 
             # doppler patch image; OK
             sh_, sw_ = bbox_to_hw_slices(bbox)
             img_ = train_img_copy.copy()[sh_, sw_, :]
-            cv2.imwrite(os.path.join(savepath, f'debug_doppler_idx_{idx}.jpg'), img_)
+            writer.imwrite(os.path.join(savepath, f'debug_doppler_idx_{idx}.jpg'), img_)
 
-    return bbox_to_hw_slices(bbox_crop if qualify else bbox)
+    return boxes
@@ -0,0 +1,152 @@
+import contextlib
+import csv
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .doppler import detect_doppler_fast, load_markers_label, get_iou, doppler_comp, plot_comp
+
+import logging
+logger = logging.getLogger('@@')
+
+# e.g. 'benign_siriraj_0001-0160_c0128_1_p0088.png' -> ('benign_siriraj_0001-0160', 'c0128', 88)
+_COMPARE_TOKENS = re.compile(r'^(?P<prefix>.+)_(?P<case>c\d+)_\d+_p(?P<page>\d+)\.png$')
+
+REPORT_FIELDS = [
+    'path_doppler', 'path_markers', 'path_markers_label', 'error',
+    'doppler_x1', 'doppler_y1', 'doppler_x2', 'doppler_y2',
+    'markers_x1', 'markers_y1', 'markers_x2', 'markers_y2',
+    'iou', 'isec_in_markers',
+]
+
+
+def get_compare_triples(root):
+    """
+    Find the (doppler, markers, markers label) triples of a tree laid out like 'Siriraj_sample_doppler_comp', i.e.
+    `Doppler_Train_Crop/`, `Markers_Train/` and `Markers_Train_Markers_Labels/`. A markers image is paired with the
+    doppler image of the same (prefix, cXXXX) tokens, the nearest pXXXX page if there are several.
+    """
+    dopplers = {}
+    for path in glob.glob(f'{root}/Doppler_Train_Crop/**/*.png', recursive=True):
+        m = _COMPARE_TOKENS.match(os.path.basename(path))
+        if m:
+            dopplers.setdefault(m.group('prefix', 'case'), []).append((int(m.group('page')), path))
+
+    triples = []
+    for path_markers in sorted(glob.glob(f'{root}/Markers_Train/**/*.png', recursive=True)):
+        m = _COMPARE_TOKENS.match(os.path.basename(path_markers))
+        candidates = dopplers.get(m.group('prefix', 'case')) if m else None
+        rel = os.path.relpath(path_markers, f'{root}/Markers_Train')
+        path_markers_label = os.path.join(f'{root}/Markers_Train_Markers_Labels', os.path.splitext(rel)[0] + '.txt')
+        if not candidates or not os.path.exists(path_markers_label):
+            continue
+        page = int(m.group('page'))
+        _, path_doppler = min(candidates, key=lambda c: (abs(c[0] - page), c[1]))
+        triples.append((path_doppler, path_markers, path_markers_label))
+    return triples
+
+
+def compare_triple(args):
+    """
+    Detection, label parsing and IoU of one triple, the same as `doppler_comp` and `get_iou` without the drawing
+    :param args: tuple of (path_doppler, path_markers, path_markers_label, plot path or None)
+    :return: a row of the report, see REPORT_FIELDS
+    """
+    path_doppler, path_markers, path_markers_label, plot_path = args
+    row = {'path_doppler': path_doppler, 'path_markers': path_markers, 'path_markers_label': path_markers_label,
+           'error': ''}
+    try:
+        img_doppler = cv2.imread(path_doppler)
+        if img_doppler is None:
+            raise ValueError(f'invalid image: {path_doppler}')
+        height, width = img_doppler.shape[:2]
+
+        bbox = detect_doppler_fast(img_doppler)
+        if bbox is None:
+            raise ValueError('detect_doppler_fast() failed')
+        bbox_doppler = np.array([int(v) for v in bbox], dtype=np.float32)
+
+        label = load_markers_label(path_markers_label)
+        bbox_markers = np.array([
+            int(width * label[:, 1].min()), int(height * label[:, 2].min()),
+            int(width * label[:, 1].max()), int(height * label[:, 2].max())], dtype=np.float32)
+
+        iou, isec_in_markers = get_iou(bbox_doppler, bbox_markers)
+        row.update(zip(REPORT_FIELDS[4:8], bbox_doppler.tolist()))
+        row.update(zip(REPORT_FIELDS[8:12], bbox_markers.tolist()))
+        row.update(iou=float(iou), isec_in_markers=float(isec_in_markers))
+
+        if plot_path is not None:
+            _, _, border_img_doppler, border_img_markers = doppler_comp(path_doppler, path_markers, path_markers_label)
+            plt = plot_comp(border_img_doppler, border_img_markers, path_doppler, path_markers)
+            plt.savefig(plot_path, bbox_inches='tight')
+            plt.close('all')
+    except Exception as e:  # reported, a broken pair shouldn't stop the audit
+        row['error'] = f'{type(e).__name__}: {e}'
+    return row
+
+
+def summarize_report(rows):
+    ious = np.array([row['iou'] for row in rows if not row['error']], dtype=np.float64)
+    summary = {
+        'pairs': len(rows),
+        'failed': len(rows) - len(ious),
+        'iou_mean': float(ious.mean()) if len(ious) else float('nan'),
+        'iou_median': float(np.median(ious)) if len(ious) else float('nan'),
+    }
+    for thresh in (0.25, 0.5, 0.75):
+        summary[f'iou_over_{thresh}'] = float((ious > thresh).mean()) if len(ious) else float('nan')
+    return summary
+
+
+def compare_bulk(triples, report_path, workers=0, plot_every=0, plot_dir=None):
+    """
+    Compare many doppler/markers pairs, streaming the rows to `report_path`
+    :param triples: list of (path_doppler, path_markers, path_markers_label), e.g. from `get_compare_triples`
+    :param report_path: '*.csv' streamed as the results arrive, or '*.parquet' written at the end (needs pyarrow)
+    :param workers: number of processes, 0 means comparing in the calling process
+    :param plot_every: if > 0, render the figure of every `plot_every`-th pair into `plot_dir`
+    :param plot_dir: the directory of the sampled figures
+    :return: the summary statistics
+    """
+    jobs = []
+    for idx, (path_doppler, path_markers, path_markers_label) in enumerate(triples):
+        plot_path = None
+        if plot_every > 0 and idx % plot_every == 0:
+            stem = os.path.splitext(os.path.basename(path_doppler))[0]
+            plot_path = os.path.join(plot_dir, f'comp-doppler-{idx:06d}-{stem}.jpg')
+        jobs.append((path_doppler, path_markers, path_markers_label, plot_path))
+
+    parquet = report_path.endswith('.parquet')
+    rows = []
+    with (contextlib.nullcontext() if parquet else open(report_path, 'w', newline='')) as f:
+        writer = None if parquet else csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        if writer is not None:
+            writer.writeheader()
+
+        if workers > 0:
+            executor = ProcessPoolExecutor(workers)
+            results = executor.map(compare_triple, jobs, chunksize=8)
+        else:
+            executor = None
+            results = map(compare_triple, jobs)
+
+        for row in results:
+            if writer is not None:
+                writer.writerow(row)
+            rows.append(row)
+            if row['error']:
+                logger.debug(f"compare_bulk(): {row['path_doppler']}: {row['error']}")
+
+        if executor is not None:
+            executor.shutdown()
+
+    if parquet:
+        import pandas as pd
+        pd.DataFrame(rows, columns=REPORT_FIELDS).to_parquet(report_path, index=False)
+
+    return summarize_report(rows)
@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+
+from ..digitake.preprocess import ThyroidDataset
+from .doppler import get_path_doppler, get_bbox_doppler
+
+
+class DopplerThyroidDataset(ThyroidDataset):
+    """
+    ThyroidDataset also resolving the doppler bbox of each sample, in the DataLoader workers
+
+    The extra is a dict of {'index': sample id, 'bbox_doppler': (4,) float tensor scaled to `bbox_size`}, the bbox
+    being NaN where `detect_doppler` found none. Sample ids are the `compact_extra` ones, see `get_paths`.
+    """
+
+    def __init__(self, phase, dataset, bbox_size, transform=None, **kwargs):
+        """
+        :param bbox_size: tuple of (H, W) of the network input, or int if square, the bbox is scaled to it
+        :param kwargs: the other ThyroidDataset options, `compact_extra` is implied
+        """
+        kwargs['compact_extra'] = True
+        super(DopplerThyroidDataset, self).__init__(phase, dataset, transform=transform, **kwargs)
+        if type(bbox_size) is int:
+            bbox_size = (bbox_size, bbox_size)
+        self.bbox_size = bbox_size
+
+    def get_bbox_doppler(self, sample_id):
+        train_img_path = self.get_path(sample_id)
+        path_doppler = get_path_doppler(train_img_path)
+        if path_doppler is None:  # strict check
+            raise ValueError(f'`path_doppler` not found for: {train_img_path}')
+
+        bbox = get_bbox_doppler(path_doppler, self.bbox_size)
+        if bbox is None:
+            return torch.full((4,), float('nan'))
+        return torch.from_numpy(np.asarray(bbox, dtype=np.float32))
+
+    def __getitem__(self, index):
+        image, class_index, sample_id = super(DopplerThyroidDataset, self).__getitem__(index)
+        return image, class_index, {'index': sample_id, 'bbox_doppler': self.get_bbox_doppler(sample_id)}
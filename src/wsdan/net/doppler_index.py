@@ -0,0 +1,109 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from ..digitake.preprocess.manifest import hash_file
+
+DOPPLER_INDEX_VERSION = 2
+
+
+def detect_bbox(path_doppler):
+    """
+    :return: tuple of (bbox of `detect_doppler_fast` in pixels or None, [H, W] of the doppler image)
+    """
+    import cv2
+    from .doppler import detect_doppler_fast
+
+    raw = cv2.imread(path_doppler)
+    if raw is None:
+        raise ValueError(f'invalid `raw` for: {path_doppler}')
+    return detect_doppler_fast(raw), list(raw.shape[:2])
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _build_entry(path_doppler):
+    size, mtime_ns = _stat(path_doppler)  # before reading, so that a concurrent rewrite leaves the entry stale
+    bbox, shape = detect_bbox(path_doppler)
+    return {'hash': hash_file(path_doppler), 'bbox': bbox, 'shape': shape, 'size': size, 'mtime_ns': mtime_ns}
+
+
+class DopplerIndex:
+    """
+    In-memory table of the doppler bboxes, keyed by path and by content hash
+
+    The bbox is kept in pixels along with the image shape, so that scaling it gives exactly what detecting it on the
+    fly did. A path missing from the table, or whose size or mtime changed since, is looked up by its content hash
+    first, and detected only if that misses too.
+    """
+
+    def __init__(self, entries=None):
+        # path -> {'hash': str, 'bbox': [4] or None, 'shape': [H, W], 'size': int, 'mtime_ns': int}
+        self.entries = entries if entries is not None else {}
+        self.by_hash = {entry['hash']: entry for entry in self.entries.values()}
+
+    @classmethod
+    def build(cls, paths, workers=0):
+        """
+        :param paths: the doppler image paths
+        :param workers: number of detecting processes, 0 means detecting in the calling process
+        """
+        paths = sorted(set(paths))
+        if workers > 0:
+            with ProcessPoolExecutor(workers) as executor:
+                entries = list(executor.map(_build_entry, paths, chunksize=16))
+        else:
+            entries = [_build_entry(path) for path in paths]
+        return cls(dict(zip(paths, entries)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            index = json.load(f)
+        assert index['version'] == DOPPLER_INDEX_VERSION, f"Unsupported doppler index version {index['version']}"
+        return cls(index['entries'])
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': DOPPLER_INDEX_VERSION, 'entries': self.entries}, f)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, path_doppler):
+        """
+        :return: tuple of (bbox in pixels or None, [H, W]) of the doppler image at `path_doppler`
+        """
+        size, mtime_ns = _stat(path_doppler)
+        entry = self.entries.get(path_doppler)
+        if entry is None or entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+            digest = hash_file(path_doppler)
+            known = self.by_hash.get(digest)
+            if known is None:
+                bbox, shape = detect_bbox(path_doppler)
+            else:
+                bbox, shape = known['bbox'], known['shape']
+            entry = {'hash': digest, 'bbox': bbox, 'shape': shape, 'size': size, 'mtime_ns': mtime_ns}
+            self.by_hash.setdefault(digest, entry)
+            self.entries[path_doppler] = entry
+        return entry['bbox'], entry['shape']
+
+
+_doppler_index = None
+
+def get_doppler_index():
+    """The doppler index of this process, loaded from `WSDAN_DOPPLER_INDEX` if set, else filled on demand"""
+    global _doppler_index
+    if _doppler_index is None:
+        path = os.environ.get('WSDAN_DOPPLER_INDEX')  # e.g. 'doppler_index_100e.json'
+        _doppler_index = DopplerIndex.load(path) if path else DopplerIndex()
+    return _doppler_index
+
+def set_doppler_index(index):
+    global _doppler_index
+    _doppler_index = index
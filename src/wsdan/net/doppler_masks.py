@@ -0,0 +1,35 @@
+import glob
+
+import cv2
+
+from ..digitake.preprocess.mask_store import build_mask_store
+from .doppler import get_path_doppler
+
+
+def doppler_flow_mask(path_doppler, color_spread=40):
+    """
+    :return: bool array of the color flow pixels of a doppler image, i.e. colored but not the green box
+    """
+    img = cv2.imread(path_doppler)
+    if img is None:
+        raise ValueError(f'invalid image: {path_doppler}')
+    b, g, r = cv2.split(img)
+    lo, hi = img.min(axis=2), img.max(axis=2)
+    box = (g > 200) & (r < 100) & (b < 100)  # as the green threshold of `detect_doppler`
+    return ((hi - lo) > color_spread) & ~box
+
+
+def _bmode_flow_mask(train_img_path):
+    path_doppler = get_path_doppler(train_img_path)
+    return doppler_flow_mask(path_doppler) if path_doppler is not None else None
+
+
+def build_doppler_mask_store(root, prefix, size, workers=0):
+    """
+    Precompute the doppler flow masks of the B-mode images of a doppler dataset root, keyed by B-mode path,
+    the B-mode images without a doppler counterpart being left out
+    :param size: tuple of (H, W) of the masks, the network input size
+    :return: the index dictionary of `build_mask_store`
+    """
+    paths = sorted(glob.glob(f'{root}/Markers_Train_Remove_Markers/**/*.png', recursive=True))
+    return build_mask_store(_bmode_flow_mask, paths, prefix, size, workers)
@@ -0,0 +1,100 @@
+import csv
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+# e.g. 'malignant_nodule3_0031-0060_c0032_1_p0005.png' -> ('malignant_nodule3_0031-0060', 'c0032')
+_BUCKET_TOKENS = re.compile(r'^(?P<prefix>.+)_(?P<case>c\d+)_\d+_p\d+\.png$')
+
+
+def frame_signature(path, hash_size=8, color_spread=40):
+    """
+    64-bit perceptual hash(pHash) of a frame, insensitive to the doppler overlay
+
+    The colored pixels(flow, box) of a doppler frame are filled with the median gray, so that it hashes alike its
+    B-mode frame. The low frequencies of the DCT are then thresholded at their median.
+    :param color_spread: max - min over the channels above which a pixel is taken as overlay
+    :return: the signature as a uint8 array of `hash_size * hash_size / 8` bytes
+    """
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f'invalid image: {path}')
+    lo, hi = img.min(axis=2), img.max(axis=2)
+    gray = lo.astype(np.float32)
+    overlay = (hi - lo) > color_spread
+    if overlay.any() and not overlay.all():
+        gray[overlay] = np.median(gray[~overlay])
+    small = cv2.resize(gray, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small)[:hash_size, :hash_size].reshape(-1)
+    bits = low > np.median(low[1:])  # the DC term would dominate the median
+    return np.packbits(bits)
+
+
+def hamming_distances(a, b):
+    """
+    :param a: (N, bytes) uint8 signatures
+    :param b: (M, bytes) uint8 signatures
+    :return: (N, M) int matrix of the hamming distances
+    """
+    return np.unpackbits(a[:, None, :] ^ b[None, :, :], axis=2).sum(axis=2)
+
+
+def get_bucket(path):
+    m = _BUCKET_TOKENS.match(os.path.basename(path))
+    return m.group('prefix', 'case') if m else None
+
+
+def pair_frames(bmode_paths, doppler_paths, max_distance=12, workers=0, bucketed=True):
+    """
+    Match each B-mode frame to its nearest doppler frame by signature, within the same (prefix, cXXXX) bucket
+    :param max_distance: pairs farther apart than this many bits are dropped
+    :param workers: number of hashing processes, 0 means hashing in the calling process
+    :param bucketed: if False, match against all the doppler frames
+    :return: dict of B-mode path to tuple of (doppler path, distance)
+    """
+    paths = list(bmode_paths) + list(doppler_paths)
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as executor:
+            signatures = list(executor.map(frame_signature, paths, chunksize=16))
+    else:
+        signatures = [frame_signature(path) for path in paths]
+    signatures = dict(zip(paths, signatures))
+
+    buckets = {}  # bucket -> ([B-mode paths], [doppler paths])
+    for kind, kind_paths in enumerate((bmode_paths, doppler_paths)):
+        for path in kind_paths:
+            buckets.setdefault(get_bucket(path) if bucketed else None, ([], []))[kind].append(path)
+
+    pairs = {}
+    for bmodes, dopplers in buckets.values():
+        if not bmodes or not dopplers:
+            continue
+        distances = hamming_distances(np.stack([signatures[p] for p in bmodes]),
+                                      np.stack([signatures[p] for p in dopplers]))
+        nearest = distances.argmin(axis=1)
+        for i, j in enumerate(nearest):
+            if distances[i, j] <= max_distance:
+                pairs[bmodes[i]] = (dopplers[j], int(distances[i, j]))
+    return pairs
+
+
+def pair_dataset(root, max_distance=12, workers=0, bucketed=True):
+    """
+    :return: the pairs of `pair_frames` for the B-mode and doppler frames of a doppler dataset root
+    """
+    bmode_paths = sorted(glob.glob(f'{root}/Markers_Train_Remove_Markers/**/*.png', recursive=True))
+    doppler_paths = sorted(glob.glob(f'{root}/Doppler_Train_Crop/**/*.png', recursive=True))
+    return pair_frames(bmode_paths, doppler_paths, max_distance, workers, bucketed)
+
+
+def save_pairs(pairs, root, path):
+    """Write the pairs as the `doppler_pairs.csv` manifest read by `get_doppler_pairs`, relative to `root`"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['# bmode', 'doppler', 'distance'])
+        for bmode, (doppler, distance) in sorted(pairs.items()):
+            writer.writerow([os.path.relpath(bmode, root), os.path.relpath(doppler, root), distance])
@@ -0,0 +1,82 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+# laid out like a doppler dataset root, see `get_doppler_pairs`
+SYNTH_DOPPLER_DIR = 'Doppler_Train_Crop/Benign/matched'
+SYNTH_MARKERS_DIR = 'Markers_Train_Remove_Markers/Benign_Remove/train'
+SYNTH_TRUTH = 'synth_truth.json'
+
+
+def synth_doppler_frame(size, rng, noise=1., occlusion=0., distractors=20):
+    """
+    Synthesize an ultrasound-like frame with a green doppler box of known geometry
+    :param size: tuple of (H, W) of the frame
+    :param rng: numpy random Generator
+    :param noise: speckle strength, 0 for a flat background
+    :param occlusion: probability of a dark bar across the box border, which `detect_doppler` is expected to miss
+    :param distractors: number of small saturated green spots, i.e. contours to be rejected
+    :return: tuple of (BGR uint8 image, ground-truth bbox [min_x, min_y, max_x, max_y] of the box border,
+        gray uint8 B-mode image, i.e. the speckle without the doppler overlay)
+    """
+    h, w = size
+
+    # speckle: rayleigh-distributed echo, smoothed, kept below the green threshold(200) of `detect_doppler`
+    echo = rng.rayleigh(40. * noise + 1e-3, (h, w)).astype(np.float32)
+    echo = cv2.GaussianBlur(echo, (0, 0), 1.5)
+    bmode = np.clip(echo, 0, 190).astype(np.uint8)
+    img = np.repeat(bmode[..., None], 3, axis=2)
+
+    # the doppler box, drawn on its own layer to know its exact pixels
+    bw, bh = int(rng.uniform(0.3, 0.8) * w), int(rng.uniform(0.3, 0.8) * h)
+    x1, y1 = int(rng.integers(2, w - bw - 2)), int(rng.integers(2, h - bh - 2))
+    layer = np.zeros((h, w), np.uint8)
+    cv2.rectangle(layer, (x1, y1), (x1 + bw, y1 + bh), 255, int(rng.integers(1, 4)))
+    ys, xs = np.nonzero(layer)
+    bbox = [float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())]
+    img[layer > 0] = (0, 255, 0)
+
+    # color flow inside the box, red/blue only so that it stays below the green threshold
+    for _ in range(int(rng.integers(1, 4))):
+        cx, cy = int(rng.integers(x1 + 4, x1 + bw - 4)), int(rng.integers(y1 + 4, y1 + bh - 4))
+        color = (255, 60, 0) if rng.random() < 0.5 else (0, 60, 255)
+        cv2.ellipse(img, (cx, cy), (int(rng.integers(3, 12)), int(rng.integers(3, 12))), 0, 0, 360, color, -1)
+
+    for _ in range(distractors):
+        cx, cy = int(rng.integers(0, w)), int(rng.integers(0, h))
+        cv2.circle(img, (cx, cy), int(rng.integers(1, 4)), (0, 255, 0), -1)
+
+    if rng.random() < occlusion:
+        ox = int(rng.integers(x1, x1 + bw))
+        cv2.rectangle(img, (ox, 0), (ox + int(rng.integers(3, 10)), h - 1), (0, 0, 0), -1)
+
+    return img, bbox, bmode
+
+
+def write_synth_corpus(root, num_frames, size, seed=0, **kwargs):
+    """
+    Write a synthetic doppler dataset root: the doppler frames, the matching B-mode frames and
+    `synth_truth.json` mapping each doppler path to its ground-truth bbox
+    :param kwargs: the options of `synth_doppler_frame`
+    :return: the ground-truth dictionary
+    """
+    if type(size) is int:
+        size = (size, size)
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, SYNTH_DOPPLER_DIR), exist_ok=True)
+    os.makedirs(os.path.join(root, SYNTH_MARKERS_DIR), exist_ok=True)
+
+    truth = {}
+    for idx in range(num_frames):
+        img, bbox, bmode = synth_doppler_frame(size, rng, **kwargs)
+        fname = f'benign_synth_0001-{num_frames:04d}_c{idx + 1:04d}_1_p{idx + 1:04d}.png'
+        path_doppler = os.path.join(root, SYNTH_DOPPLER_DIR, fname)
+        cv2.imwrite(path_doppler, img)
+        cv2.imwrite(os.path.join(root, SYNTH_MARKERS_DIR, fname), bmode)
+        truth[path_doppler] = bbox
+
+    with open(os.path.join(root, SYNTH_TRUTH), 'w') as f:
+        json.dump(truth, f)
+    return truth
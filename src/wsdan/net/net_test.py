@@ -3,6 +3,8 @@ from torch.nn import functional
 
 from .metric import TopKAccuracyMetric
 from .augment import batch_augment, get_raw_image, dump_heatmap
+from .net_train import get_batch_paths, forward
+from .debug_writer import get_debug_writer
 
 import logging
 
@@ -10,7 +12,13 @@ from tqdm import tqdm
 #from tqdm.notebook import tqdm
 
 
-def test(device, net, batch_size, data_loader, ckpt, savepath=None):
+def test(device, net, batch_size, data_loader, ckpt, savepath=None, bf16=False):
+    """
+    Evaluate `net` streaming over `data_loader`, keeping only the per-sample outputs, so memory doesn't grow with
+    the test set beyond (N, num_classes) logits; the raw and crop logits are combined once all the batches are done
+    :param bf16: if True, run the forwards under CPU bfloat16 autocast, see `net_train.forward`
+    :return: tuple of (None, None, logits, labels, paths) on cpu, the first two kept for the former (X, crop_image)
+    """
     logging.info('Network loading from {}'.format(ckpt))
 
     ckpt_dict = torch.load(ckpt)
@@ -31,7 +39,12 @@ def test(device, net, batch_size, data_loader, ckpt, savepath=None):
     ref_accuracy = TopKAccuracyMetric()
     raw_accuracy.reset()
 
-    results = []
+    num_samples = len(data_loader.dataset)
+    logits = torch.empty((num_samples, net.num_classes))  # raw, then refined once all the batches are done
+    crop_logits = torch.empty((num_samples, net.num_classes))
+    labels = torch.empty(num_samples, dtype=torch.long)
+    all_paths = [None] * num_samples
+    offset = 0
     net.eval()
 
     with torch.no_grad():
@@ -40,7 +53,7 @@ def test(device, net, batch_size, data_loader, ckpt, savepath=None):
         pbar.set_description('Test data')
 
         for i, (X, y, p) in enumerate(data_loader):
-            paths = p['path']  # @@
+            paths = get_batch_paths(data_loader, p)  # @@
 
             # obtain data for testing
             X = X.to(device)
@@ -49,7 +62,7 @@ def test(device, net, batch_size, data_loader, ckpt, savepath=None):
             ##################################
             # Raw Image
             ##################################
-            y_pred_raw, _, attention_maps = net(X)
+            y_pred_raw, _, attention_maps = forward(net, X, bf16)
 
             ##################################
             # Attention Cropping
@@ -59,31 +72,46 @@ def test(device, net, batch_size, data_loader, ckpt, savepath=None):
                 mode='crop', theta=0.85, padding_ratio=0.05)
 
             # crop images forward
-            y_pred_crop, _, _ = net(crop_image)
-            importance =  torch.abs(y_pred_raw[0] - y_pred_raw[1])
-
-            y_pred = (y_pred_raw + (y_pred_crop * 2 * importance)) / 3.
+            y_pred_crop, _, _ = forward(net, crop_image, bf16)
 
             if savepath is not None:
                 raw_image = get_raw_image(X.cpu())
                 batches, _, imgH, imgW = X.size()
                 for idx in range(batches):
-                    dump_heatmap(savepath, '%06d' % (i * batch_size + idx),
-                                 raw_image, attention_maps[idx:idx + 1], imgH, imgW, idx)
+                    dump_heatmap(savepath, '%06d' % (offset + idx),
+                                 raw_image, attention_maps[idx:idx + 1], imgH, imgW, idx, block=True)
 
-            results = (X, crop_image, y_pred, y, p)
+            batches = X.size(0)
+            logits[offset:offset + batches] = y_pred_raw.cpu()
+            crop_logits[offset:offset + batches] = y_pred_crop.cpu()
+            labels[offset:offset + batches] = y.cpu()
+            all_paths[offset:offset + batches] = paths
+            offset += batches
 
             # Top K
             epoch_raw_acc = raw_accuracy(y_pred_raw, y)
-            epoch_ref_acc = ref_accuracy(y_pred, y)
 
             # end of this batch
-            batch_info = 'Val Acc: Raw ({:.2f}), Refine ({:.2f})'.format(
-                epoch_raw_acc[0], epoch_ref_acc[0])
+            batch_info = 'Val Acc: Raw ({:.2f})'.format(epoch_raw_acc[0])
             pbar.update()
             pbar.set_postfix_str(batch_info)
             torch.cuda.empty_cache()
 
         pbar.close()
 
-    return results
\ No newline at end of file
+    # from the first two samples, as when the whole test set was evaluated as a single batch, whatever the
+    # `batch_size`; a single sample is refined with equal class weights
+    logits, crop_logits, labels = logits[:offset], crop_logits[:offset], labels[:offset]
+    if offset > 1:
+        importance = torch.abs(logits[0] - logits[1])
+    else:
+        importance = torch.ones(net.num_classes)
+    logits = (logits + (crop_logits * 2 * importance)) / 3.
+
+    epoch_ref_acc = ref_accuracy(logits, labels)
+    print('@@ Val Acc: Raw ({:.2f}), Refine ({:.2f})'.format(epoch_raw_acc[0], epoch_ref_acc[0]))
+
+    if savepath is not None:
+        get_debug_writer().flush()  # the heatmaps are written in the background
+
+    return None, None, logits, labels, all_paths[:offset]
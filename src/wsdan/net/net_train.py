@@ -1,13 +1,12 @@
 import torch
 from torch import nn
 from torch.nn import functional
-from torch.utils.tensorboard import SummaryWriter
 
 from .metric import AverageMeter, TopKAccuracyMetric
-from .augment import batch_augment, img_gpu_to_cpu
+from .augment import batch_augment, imwrite_normalized
+from .debug_writer import get_debug_writer, is_debug_enabled
 from .checkpoint import ModelCheckpoint
 
-import cv2
 import numpy as np
 import logging
 import os
@@ -28,6 +27,31 @@ def softmax(x):
   return e_x / e_x.sum()
 
 
+def get_batch_paths(data_loader, p):
+    """Paths of a batch, given its extra as either dict of lists or collated sample ids (`compact_extra`)"""
+    if isinstance(p, dict):
+        if 'path' in p:
+            return p['path']
+        p = p['index']  # e.g. DopplerThyroidDataset
+    return data_loader.dataset.get_paths(p)
+
+
+def get_batch_bboxes_doppler(p, device):
+    """(B, 4) doppler bboxes of a batch resolved by the workers(DopplerThyroidDataset), or None"""
+    if isinstance(p, dict) and 'bbox_doppler' in p:
+        return p['bbox_doppler'].to(device)
+    return None
+
+
+def forward(net, X, bf16=False):
+    """
+    `net(X)`, under CPU bfloat16 autocast if `bf16`, the outputs cast back to float32 so that the losses and metrics
+    stay in float32
+    """
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        return tuple(t.float() for t in net(X))
+
+
 class SaveFeatures():  # @@ not used at the moment
     features=None
     def __init__(self, m): self.hook = m.register_forward_hook(self.hook_fn)
@@ -36,7 +60,7 @@ class SaveFeatures():  # @@ not used at the moment
 
 
 def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
-           with_doppler, config_doppler, savepath_epoch):
+           with_doppler, config_doppler, savepath_epoch, bf16=False):
 
     # metrics initialization
     loss_container.reset()
@@ -48,13 +72,16 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
     net.train()
 
     example_ct = 0
+    data_wait = 0.  # time blocked on `train_loader`, i.e. the workers don't keep up with the model
+    batch_start = time.perf_counter()
     for batch_idx, (X, y, p) in enumerate(train_loader):
+        data_wait += time.perf_counter() - batch_start
         optimizer.zero_grad()
 
         #print(f"(batch_idx={batch_idx}) X[0].shape:", X[0].shape)
-        paths = p['path']  # @@
+        paths = get_batch_paths(train_loader, p)  # @@
 
-        if savepath_epoch:
+        if savepath_epoch and get_debug_writer().wants(batch_idx):
             savepath_batch = os.path.join(savepath_epoch, f'batch_{batch_idx}')
             if not os.path.exists(savepath_batch):
                 os.makedirs(savepath_batch, exist_ok=True)
@@ -63,12 +90,13 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
 
         X = X.to(device)
         y = y.to(device)
+        bboxes_doppler = get_batch_bboxes_doppler(p, device) if with_doppler else None
 
         ##################################
         # Raw Image
         ##################################
         # raw images forward
-        y_pred_raw, feature_matrix, attention_map = net(X)
+        y_pred_raw, feature_matrix, attention_map = forward(net, X, bf16)
 
         # Update Feature Center
         feature_center_batch = functional.normalize(feature_center[y], dim=-1)
@@ -80,16 +108,16 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
         with torch.no_grad():
             crop_images = batch_augment(X, paths, attention_map[:, :1, :, :],
                 savepath=savepath_batch,
-                use_doppler=with_doppler, config_doppler=config_doppler,
+                use_doppler=with_doppler, config_doppler=config_doppler, bboxes_doppler=bboxes_doppler,
                 mode='crop', theta=(0.7, 0.95), padding_ratio=0.1)
 
-        if savepath_batch:  # @@
-            for idx in range(crop_images.shape[0]):
+        if savepath_batch:  # @@ only the device-to-host copy stays on this thread
+            for idx in get_debug_writer().sample_indices(crop_images.shape[0]):
                 fname = os.path.join(savepath_batch, f'final_crop_idx_{idx}.jpg')
-                cv2.imwrite(fname, img_gpu_to_cpu(crop_images[idx]))
+                get_debug_writer().submit(imwrite_normalized, fname, crop_images[idx].cpu())
 
         # crop images forward
-        y_pred_crop, _, _ = net(crop_images)
+        y_pred_crop, _, _ = forward(net, crop_images, bf16)
 
         ##################################
         # Attention Dropping
@@ -97,18 +125,18 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
         with torch.no_grad():
             drop_images = batch_augment(X, paths, attention_map[:, 1:, :, :],
                 savepath=savepath_batch,
-                use_doppler=with_doppler, config_doppler=config_doppler,
+                use_doppler=with_doppler, config_doppler=config_doppler, bboxes_doppler=bboxes_doppler,
                 mode='drop', theta=(0.2, 0.5))
 
         if savepath_batch:  # @@
-            for idx in range(drop_images.shape[0]):
+            for idx in get_debug_writer().sample_indices(drop_images.shape[0]):
                 fname = os.path.join(savepath_batch, f'final_drop_idx_{idx}.jpg')
-                cv2.imwrite(fname, img_gpu_to_cpu(drop_images[idx]))
+                get_debug_writer().submit(imwrite_normalized, fname, drop_images[idx].cpu())
 
         ##if with_doppler: exit(99)  # @@ !!!!
 
         # drop images forward
-        y_pred_drop, _, _ = net(drop_images)
+        y_pred_drop, _, _ = forward(net, drop_images, bf16)
 
         # loss
         batch_loss = cross_entropy_loss(y_pred_raw, y) / 3. + \
@@ -132,10 +160,10 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
             epoch_loss, epoch_raw_acc[0],
             epoch_crop_acc[0], epoch_drop_acc[0])
 
-        writer.add_scalar("Loss/train", epoch_loss, batch_idx)
-        writer.add_scalar('Acc(Raw)/train', epoch_raw_acc[0], batch_idx)
-        writer.add_scalar('Acc(Crop)/train', epoch_crop_acc[0], batch_idx)
-        writer.add_scalar('Acc(Drop)/train', epoch_drop_acc[0], batch_idx)
+        get_writer().add_scalar("Loss/train", epoch_loss, batch_idx)
+        get_writer().add_scalar('Acc(Raw)/train', epoch_raw_acc[0], batch_idx)
+        get_writer().add_scalar('Acc(Crop)/train', epoch_crop_acc[0], batch_idx)
+        get_writer().add_scalar('Acc(Drop)/train', epoch_drop_acc[0], batch_idx)
 
         example_ct += len(X)
         metrics = {
@@ -152,6 +180,7 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
         pbar.update()
         pbar.set_postfix_str(batch_info)
         torch.cuda.empty_cache()
+        batch_start = time.perf_counter()
 
     # end of this epoch
     logs['train/{}'.format(loss_container.name)] = epoch_loss
@@ -160,12 +189,38 @@ def _train(device, logs, train_loader, net, feature_center, optimizer, pbar,
     logs['train/drop_{}'.format(drop_metric.name)] = epoch_drop_acc
     logs['train/info'] = batch_info
     end_time = time.time()
+    logs['train/data_wait'] = data_wait
 
     # write log for this epoch
-    logging.info('Train: {}, Time {:3.2f}'.format(batch_info, end_time - start_time))
+    logging.info('Train: {}, Time {:3.2f}, Data wait {:3.2f} ({:.1%})'.format(
+        batch_info, end_time - start_time, data_wait, data_wait / max(end_time - start_time, 1e-9)))
+
+    cache = getattr(train_loader.dataset, 'cache', None)
+    if cache is not None:
+        logging.info('Train: {}'.format(cache))
 
 
-def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
+def measure_data_wait(data_loader, step_fn, num_batches):
+    """
+    Time `num_batches` steps of `step_fn` fed by `data_loader`, after a first batch spent on starting the workers
+    :return: tuple of (seconds blocked on the loader, seconds in `step_fn`)
+    """
+    data_wait, step_time = 0., 0.
+    batches = iter(data_loader)
+    step_fn(next(batches))
+
+    batch_start = time.perf_counter()
+    for _, batch in zip(range(num_batches), batches):
+        step_start = time.perf_counter()
+        data_wait += step_start - batch_start
+        step_fn(batch)
+        batch_start = time.perf_counter()
+        step_time += batch_start - step_start
+
+    return data_wait, step_time
+
+
+def _validate(device, logs, validate_loader, net, pbar, savepath_epoch, bf16=False):
 
     # metrics initialization
     val_loss_container.reset()
@@ -176,9 +231,9 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
     net.eval()
     with torch.no_grad():
       for i, (X, y, p) in enumerate(validate_loader):
-          paths = p['path']  # @@
+          paths = get_batch_paths(validate_loader, p)  # @@
 
-          if savepath_epoch:
+          if savepath_epoch and get_debug_writer().wants(i):
               savepath_batch = os.path.join(savepath_epoch, f'batch_{i}')
               if not os.path.exists(savepath_batch):
                   os.makedirs(savepath_batch, exist_ok=True)
@@ -192,7 +247,7 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
           ##################################
           # Raw Image
           ##################################
-          y_pred_raw, _, attention_map = net(X)
+          y_pred_raw, _, attention_map = forward(net, X, bf16)
 
           ##################################
           # Object Localization and Refinement
@@ -200,7 +255,7 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
           crop_images = batch_augment(X, paths, attention_map,
               savepath=savepath_batch, use_doppler=False,
               mode='crop', theta=(0.7, 0.95), padding_ratio=0.05)
-          y_pred_crop, _, _ = net(crop_images)
+          y_pred_crop, _, _ = forward(net, crop_images, bf16)
 
           ##################################
           # Final prediction
@@ -210,7 +265,7 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
           #print("Y_Prediction vs Y_True")
           pred_labels = torch.argmax(y_pred, axis=1)
           pairs = torch.stack((pred_labels, y), dim=1).cpu()
-          pairs_with_path = list(zip(pairs, p))
+          pairs_with_path = list(zip(pairs, paths))
           for (pair, path) in pairs_with_path:
               if (pair[0] - pair[1]) != 0:
                   top_misclassified[path] = top_misclassified.get(path,0) + 1
@@ -260,11 +315,11 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
         'drop': logs['train/drop_topk_accuracy'][0]
     }
 
-    writer.add_scalars("Loss", loss, epoch)
-    writer.add_scalars('Acc', raw_acc, epoch)
-    writer.add_scalars('Acc/Crop-Drop', crop_drop_acc, epoch)
+    get_writer().add_scalars("Loss", loss, epoch)
+    get_writer().add_scalars('Acc', raw_acc, epoch)
+    get_writer().add_scalars('Acc/Crop-Drop', crop_drop_acc, epoch)
 
-    writer.flush()
+    get_writer().flush()
 
     # end of validation
     logs['val/{}'.format(loss_container.name)] = epoch_loss
@@ -284,6 +339,10 @@ def _validate(device, logs, validate_loader, net, pbar, savepath_epoch):
 
     # write log for this epoch
     logging.info('Valid: {}, Time {:3.2f}'.format(batch_info, end_time - start_time))
+
+    cache = getattr(validate_loader.dataset, 'cache', None)
+    if cache is not None:
+        logging.info('Valid: {}'.format(cache))
     logging.info('')
 
 
@@ -319,11 +378,23 @@ drop_metric = TopKAccuracyMetric()
 
 
 top_misclassified = {}
-writer = SummaryWriter()
+_writer = None
+
+def get_writer():
+    """The tensorboard SummaryWriter, created on first use as it makes the `runs/` directory"""
+    global _writer
+    if _writer is None:
+        from torch.utils.tensorboard import SummaryWriter
+        _writer = SummaryWriter()
+    return _writer
 
 def train(device, net, feature_center, batch_size, kfold_loaders,
              optimizer, scheduler, run_name, logs, start_epoch, total_epochs,
-             with_doppler=False, config_doppler=None, savepath='.'):
+             with_doppler=False, config_doppler=None, savepath='.', bf16=False):
+    """
+    :param bf16: if True, run the forwards under CPU bfloat16 autocast, see `forward`; the sign-sqrt of BAP, the
+                 losses and the feature centers stay in float32
+    """
     # ?? - include the 'Run/XX_d' tensorboard in output
 
     mc_monitor = 'val/{}'.format(raw_metric.name)
@@ -362,7 +433,7 @@ def train(device, net, feature_center, batch_size, kfold_loaders,
 
             logging.info('Epoch {:g}, Learning Rate {:g}'.format(num_epoch, optimizer.param_groups[0]['lr']))
 
-            if 0 and num_epoch < 3:  # debug
+            if is_debug_enabled():  # debug, e.g. WSDAN_DEBUG_EVERY=50 WSDAN_DEBUG_SAMPLES=2
                 savepath_epoch = os.path.join(savepath, f'epoch_{num_epoch}')
                 if not os.path.exists(savepath_epoch):
                     os.makedirs(savepath_epoch, exist_ok=True)
@@ -375,10 +446,10 @@ def train(device, net, feature_center, batch_size, kfold_loaders,
             pbar.set_description('Epoch {}/{}'.format(num_epoch, total_epochs))
 
             _train(device, logs, train_loader, net, feature_center, optimizer,
-                pbar, with_doppler, config_doppler, savepath_epoch)
+                pbar, with_doppler, config_doppler, savepath_epoch, bf16)
 
             _validate(device, logs, validate_loader, net,
-                pbar, savepath_epoch)
+                pbar, savepath_epoch, bf16)
 
             #
 
@@ -392,10 +463,14 @@ def train(device, net, feature_center, batch_size, kfold_loaders,
 
             #@@wandb.log(logs)
             pbar.close()
-            writer.flush()
+            get_writer().flush()
 
             gc.collect()
             torch.cuda.empty_cache()
 
+    if is_debug_enabled():
+        get_debug_writer().flush()
+        print('@@ debug writer - dropped:', get_debug_writer().dropped, 'failed:', get_debug_writer().failed)
+
     #@@wandb.finish()
     return mc.get_savepath_last()  # @@
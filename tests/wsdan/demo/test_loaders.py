@@ -0,0 +1,56 @@
+import numpy as np
+from PIL import Image
+
+from wsdan.demo import KFoldLoaders, create_train_loader, create_validate_loader
+from wsdan.digitake.preprocess.mask_store import MaskStore, build_mask_store
+
+
+def _left_mask(path):
+    mask = np.zeros((20, 32), dtype=bool)
+    mask[:, :16] = True
+    return mask
+
+
+def test_loaders_cache_with_mask_store(tmp_path):
+    ds_path = {'benign': [], 'malignant': []}
+    for i, label in enumerate(('benign', 'benign', 'malignant', 'malignant')):
+        ds_path[label].append(str(tmp_path / f'{i}.png'))
+        Image.fromarray(np.full((20, 32, 3), 10 * i, dtype=np.uint8)).save(ds_path[label][-1])
+
+    prefix = str(tmp_path / 'masks')
+    build_mask_store(_left_mask, ds_path['benign'] + ds_path['malignant'], prefix, 16)
+    mask_store = MaskStore(prefix)
+
+    for create_loader in (create_train_loader, create_validate_loader):
+        loader = create_loader(ds_path, 16, 2, 0, cache_bytes=1 << 20, mask_store=mask_store)
+        cache = loader.dataset.cache
+        assert cache.item_shape == (16, 16, 4)
+
+        for _ in range(2):  # decoded, then served by the cache
+            for X, _, _ in loader:
+                assert X.shape[1] == 4
+        assert cache.stats()['hits'] == 4, f"{cache.stats()}"
+
+
+def test_kfold_loaders_share_persistent_workers(tmp_path):
+    paths = []
+    for i in range(6):
+        paths.append(str(tmp_path / f'{i}.png'))
+        Image.fromarray(np.full((20, 32, 3), 10 * i, dtype=np.uint8)).save(paths[-1])
+    benign, malignant = paths[:3], paths[3:]
+    kfold_ds_paths = [({'benign': benign[:v] + benign[v + 1:], 'malignant': malignant[:v] + malignant[v + 1:]},
+                       {'benign': [benign[v]], 'malignant': [malignant[v]]}) for v in range(3)]
+
+    kfold_loaders = KFoldLoaders(kfold_ds_paths, lambda ds_path, train_sampler, validate_sampler: (
+        create_train_loader(ds_path, 16, 2, 1, sampler=train_sampler),
+        create_validate_loader(ds_path, 16, 2, 1, sampler=validate_sampler)))
+    assert len(kfold_loaders) == 3
+
+    for _ in range(2):  # epochs
+        for k in range(len(kfold_loaders)):
+            train_loader, validate_loader = kfold_loaders[k]
+            assert (train_loader, validate_loader) == kfold_loaders.loaders
+            for loader, fold_ds_path in zip((train_loader, validate_loader), kfold_ds_paths[k]):
+                assert loader.num_workers == 1 and loader.persistent_workers
+                seen = [path for _, _, p in loader for path in loader.dataset.get_paths(p)]
+                assert sorted(seen) == sorted(fold_ds_path['benign'] + fold_ds_path['malignant'])
@@ -0,0 +1,18 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from wsdan.demo.transform import get_batch_transform, get_transform
+
+
+def test_batch_transform_matches_basic_and_test():
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 255, (40, 48, 4), dtype=np.uint8), 'RGBA')
+
+    for phase, with_alpha_channel in (('basic', True), ('test', True), ('test', False)):
+        if not with_alpha_channel:
+            image = image.convert('RGB')
+        worker_transform, batch_transform = get_batch_transform(32, phase, with_alpha_channel)
+        output = batch_transform(worker_transform(image)[None])[0]
+        expected = get_transform(32, phase, with_alpha_channel)(image)
+        assert output.shape == expected.shape and torch.allclose(output, expected, atol=1e-5), phase
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from wsdan.net.doppler import detect_doppler, detect_doppler_fast
+from wsdan.net.doppler_synth import synth_doppler_frame
+
+
+@pytest.mark.parametrize('occlusion', [0., 0.3])
+def test_detect_doppler_fast_downscaled_parity(occlusion):
+    rng = np.random.default_rng(0)
+    for size in (256, 512):
+        for _ in range(50):
+            img, _, _ = synth_doppler_frame((size, size), rng, occlusion=occlusion)
+            expected = detect_doppler(img)
+            expected = None if expected is None else [float(v) for v in expected]
+            assert detect_doppler_fast(img) == expected
+            for scale in (0.5, 0.25):
+                assert detect_doppler_fast(img, scale=scale) == expected, f'size {size}, scale {scale}'
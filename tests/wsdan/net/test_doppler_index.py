@@ -0,0 +1,22 @@
+import os
+import shutil
+
+from wsdan.net.doppler_index import DopplerIndex, detect_bbox
+from wsdan.net.doppler_synth import write_synth_corpus
+
+
+def test_doppler_index_revalidates_rewritten_files(tmp_path):
+    path_a, path_b = sorted(write_synth_corpus(str(tmp_path), 2, 128))
+    bbox_a, bbox_b = detect_bbox(path_a)[0], detect_bbox(path_b)[0]
+    assert bbox_a != bbox_b
+
+    index_path = str(tmp_path / 'doppler_index.json')
+    DopplerIndex.build([path_a, path_b]).save(index_path)
+    index = DopplerIndex.load(index_path)
+    assert index.lookup(path_a)[0] == bbox_a
+
+    shutil.copyfile(path_b, path_a)  # overwritten in place
+    mtime_ns = index.entries[path_a]['mtime_ns'] + 1_000_000_000
+    os.utime(path_a, ns=(mtime_ns, mtime_ns))
+    assert index.lookup(path_a)[0] == bbox_b
+    assert index.entries[path_a]['hash'] == index.entries[path_b]['hash']  # found by hash, not detected again
@@ -0,0 +1,8 @@
+import subprocess
+import sys
+
+
+def test_net_train_import_without_cv2():
+    out = subprocess.run([sys.executable, '-c', "import sys, wsdan.net.net_train; print('cv2' in sys.modules)"],
+                         check=True, capture_output=True, text=True).stdout
+    assert out.strip().splitlines()[-1] == 'False'
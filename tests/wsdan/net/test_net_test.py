@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from wsdan.demo import ThyroidDataset, get_transform
+from wsdan.net import WSDAN, net_test
+
+
+def _test_loader(tmp_path, batch_size):
+    ds_path = {'benign': [], 'malignant': []}
+    rng = np.random.default_rng(0)
+    for i, label in enumerate(('benign', 'benign', 'malignant')):
+        ds_path[label].append(str(tmp_path / f'{i}.png'))
+        Image.fromarray(rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)).save(ds_path[label][-1])
+
+    dataset = ThyroidDataset('test', ds_path, get_transform(32, 'basic'), with_alpha_channel=False,
+                             compact_extra=True)
+    return DataLoader(dataset, batch_size=batch_size)
+
+
+def test_net_test_batch_size_invariant(tmp_path):
+    torch.manual_seed(0)
+    net = WSDAN(num_classes=2, M=2, model='resnet34', pretrained=False)
+    ckpt = str(tmp_path / 'net.ckpt')
+    torch.save({'state_dict': net.state_dict()}, ckpt)
+
+    _, _, logits, labels, paths = net_test.test('cpu', net, 3, _test_loader(tmp_path, 3), ckpt)
+    assert logits.shape == (3, 2) and labels.tolist() == [0, 0, 1] and len(paths) == 3
+
+    # a single sample per batch, the importance still taken from the first two samples
+    _, _, logits_1, labels_1, paths_1 = net_test.test('cpu', net, 1, _test_loader(tmp_path, 1), ckpt)
+    assert torch.allclose(logits_1, logits, atol=1e-5) and labels_1.tolist() == [0, 0, 1] and paths_1 == paths